@@ -0,0 +1,420 @@
+#
+# asyncio variants of the Interface API on psycopg 3
+#
+# Mỗi lệnh insert gửi INSERT ratings, INSERT partition (và cập nhật rr_index_tracker) cùng COMMIT
+# trong một lần flush nhờ pipeline mode. Các hàm nhận một AsyncConnection hoặc một AsyncConnectionPool;
+# với pool, mỗi lời gọi mượn một kết nối riêng nên nhiều insert có thể chạy song song trong một process.
+#
+import asyncio
+import contextlib
+import weakref
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+import Metrics
+from Interface import (
+    COMPACT_RATING_TYPE,
+    COPY_CHUNK_BYTES,
+    LAYOUT_CHANNEL,
+    RATING_TYPE,
+    PartitionLayout,
+    _STATS_UPSERT,
+    _RatingsFileReader,
+    _range_bounds,
+    _range_index,
+)
+
+# AsyncConnection -> {prefix: PartitionLayout}
+_layout_cache = weakref.WeakKeyDictionary()
+# Các kết nối đã đăng ký notify handler
+_listening = weakref.WeakSet()
+# (ratings, các bảng partition) -> câu lệnh roundrobininsert đã dựng sẵn
+_rr_insert_sql = {}
+
+async def getopenconnection(user='postgres', password='123456', dbname='postgres'):
+    try:
+        return await psycopg.AsyncConnection.connect(
+            dbname=dbname,
+            user=user,
+            host='localhost',
+            password=password,
+            port=5432,
+        )
+    except Exception as e:
+        print(f"Error connecting to DB: {e}")
+        raise
+
+async def create_pool(user='postgres', password='123456', dbname='postgres', min_size=1, max_size=10):
+    """Open an AsyncConnectionPool usable as `openconnection` by every function here."""
+    pool = AsyncConnectionPool(
+        f"dbname={dbname} user={user} password={password} host=localhost port=5432",
+        min_size=min_size,
+        max_size=max_size,
+        open=False,
+    )
+    await pool.open()
+    return pool
+
+async def _refresh_partition_stats(conn, prefix, table_names):
+    # Cùng nội dung với Interface._refresh_partition_stats, gửi trong pipeline đang mở.
+    # table_names rỗng chỉ xóa dòng cũ của prefix (bố cục dựng lại không kèm thống kê)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS partition_stats (
+            partition_table_name VARCHAR(50) PRIMARY KEY,
+            row_count BIGINT NOT NULL,
+            rating_sum FLOAT NOT NULL,
+            rating_sumsq FLOAT NOT NULL,
+            rating_min FLOAT,
+            rating_max FLOAT
+        );
+    """)
+    await conn.execute("DELETE FROM partition_stats WHERE starts_with(partition_table_name, %s);", (prefix,))
+    for table_name in table_names:
+        await conn.execute(f"""
+            INSERT INTO partition_stats
+                (partition_table_name, row_count, rating_sum, rating_sumsq, rating_min, rating_max)
+            SELECT %s, COUNT(*), COALESCE(SUM(rating::FLOAT), 0), COALESCE(SUM(rating::FLOAT * rating), 0),
+                   MIN(rating), MAX(rating)
+            FROM {table_name};
+        """, (table_name,))
+
+async def _add_partition_stats(conn, table_name, rating):
+    await conn.execute("""
+        INSERT INTO partition_stats
+            (partition_table_name, row_count, rating_sum, rating_sumsq, rating_min, rating_max)
+        VALUES (%s, 1, %s, %s, %s, %s)
+    """ + _STATS_UPSERT, (table_name, rating, rating * rating, rating, rating))
+
+@contextlib.asynccontextmanager
+async def _connection(openconnection):
+    if isinstance(openconnection, AsyncConnectionPool):
+        async with openconnection.connection() as conn:
+            yield conn
+    else:
+        yield openconnection
+
+async def loadratings(ratingstablename, ratingsfilepath, openconnection, compact=False):
+    span = Metrics.span('async_loadratings')
+    async with _connection(openconnection) as conn:
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(f"DROP TABLE IF EXISTS {ratingstablename} CASCADE;")
+                await cur.execute(f"""
+                    CREATE TABLE {ratingstablename} (
+                        userid INTEGER,
+                        movieid INTEGER,
+                        rating {COMPACT_RATING_TYPE if compact else RATING_TYPE}
+                    );
+                """)
+                span.mark('drop_create')
+                with open(ratingsfilepath, 'rb') as f:
+                    reader = _RatingsFileReader(f)
+                    async with cur.copy(f"COPY {ratingstablename} (userid, movieid, rating) FROM STDIN") as copy:
+                        # Đọc file trong thread để không chặn event loop
+                        while chunk := await asyncio.to_thread(reader.read, COPY_CHUNK_BYTES):
+                            await copy.write(chunk)
+                span.mark('fill')
+            await conn.commit()
+            span.mark('commit')
+            span.finish(reader.rows)
+            return reader.rows
+        except Exception as e:
+            span.fail()
+            await conn.rollback()
+            print(f"Error loading ratings: {e}")
+            raise
+
+async def _check_not_native(conn, table_names):
+    cur = await conn.execute("SELECT relname FROM pg_class WHERE relispartition AND relname = ANY(%s);",
+                             (list(table_names),))
+    row = await cur.fetchone()
+    if row:
+        raise ValueError(f"{row[0]} is a declarative partition of the ratings table; rebuild it with Interface (native=True).")
+
+async def rangepartition(ratingstablename, numberofpartitions, openconnection, boundaries=None, stats=False):
+    """Set-based range partitioning; all DDL, fills and metadata go out in one pipeline.
+    partition_stats is maintained only with `stats`."""
+    span = Metrics.span('async_rangepartition')
+    if numberofpartitions <= 0:
+        raise ValueError("Number of partitions must be greater than 0.")
+    bounds = _range_bounds(numberofpartitions, boundaries)
+    table_names = [f"range_part{i}" for i in range(numberofpartitions)]
+    async with _connection(openconnection) as conn:
+        try:
+            await _check_not_native(conn, table_names)
+            span.mark('setup')
+            fills = []
+            async with conn.pipeline():
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS range_metadata (
+                        partition_id SERIAL PRIMARY KEY,
+                        partition_table_name VARCHAR(50) NOT NULL UNIQUE,
+                        range_start FLOAT NOT NULL,
+                        range_end FLOAT NOT NULL
+                    );
+                """)
+                await conn.execute("DELETE FROM range_metadata;")
+                for i, (table_name, (minRange, maxRange)) in enumerate(zip(table_names, bounds)):
+                    lower_op = '>=' if i == 0 else '>'
+                    await conn.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE;")
+                    await conn.execute(f"CREATE TABLE {table_name} (LIKE {ratingstablename});")
+                    # Mỗi partition một cursor để đọc rowcount sau khi pipeline đồng bộ
+                    fills.append(await conn.execute(f"""
+                        INSERT INTO {table_name} (userid, movieid, rating)
+                        SELECT userid, movieid, rating FROM {ratingstablename}
+                        WHERE rating {lower_op} %s AND rating <= %s;
+                    """, (minRange, maxRange)))
+                    await conn.execute("""
+                        INSERT INTO range_metadata (partition_table_name, range_start, range_end)
+                        VALUES (%s, %s, %s);
+                    """, (table_name, minRange, maxRange))
+                await _refresh_partition_stats(conn, 'range_part', table_names if stats else [])
+                await conn.execute("SELECT pg_notify(%s, %s);", (LAYOUT_CHANNEL, 'range_part'))
+                await conn.commit()
+            span.mark('fill')
+            invalidate_partition_layout('range_part')
+            counts = [cur.rowcount for cur in fills]
+            span.finish(sum(counts))
+            return counts
+        except Exception as e:
+            span.fail()
+            await conn.rollback()
+            print(f"Error in range partition: {e}")
+            raise
+
+async def roundrobinpartition(ratingstablename, numberofpartitions, openconnection, stats=False):
+    span = Metrics.span('async_roundrobinpartition')
+    if numberofpartitions <= 0:
+        raise ValueError("Number of partitions must be greater than 0.")
+    table_names = [f"rrobin_part{i}" for i in range(numberofpartitions)]
+    async with _connection(openconnection) as conn:
+        try:
+            await _check_not_native(conn, table_names)
+            span.mark('setup')
+            fills = []
+            async with conn.pipeline():
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS roundrobin_metadata (
+                        partition_id SERIAL PRIMARY KEY,
+                        partition_table_name VARCHAR(50) NOT NULL UNIQUE
+                    );
+                """)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS rr_index_tracker (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        last_rr_index INTEGER
+                    );
+                """)
+                await conn.execute("DELETE FROM roundrobin_metadata;")
+                await conn.execute("DROP TABLE IF EXISTS temp_rr_table;")
+                await conn.execute(f"""
+                    CREATE TEMP TABLE temp_rr_table AS
+                    SELECT userid, movieid, rating,
+                           ROW_NUMBER() OVER (ORDER BY userid, movieid) AS rnum
+                    FROM {ratingstablename};
+                """)
+                for i, table_name in enumerate(table_names):
+                    await conn.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE;")
+                    await conn.execute(f"CREATE TABLE {table_name} (LIKE {ratingstablename});")
+                    fills.append(await conn.execute(f"""
+                        INSERT INTO {table_name} (userid, movieid, rating)
+                        SELECT userid, movieid, rating
+                        FROM temp_rr_table
+                        WHERE MOD(rnum - 1, %s) = %s;
+                    """, (numberofpartitions, i)))
+                    await conn.execute("INSERT INTO roundrobin_metadata (partition_table_name) VALUES (%s);",
+                                       (table_name,))
+                # last_rr_index = (tổng số dòng - 1) mod n, tính ngay trên server
+                await conn.execute("""
+                    INSERT INTO rr_index_tracker (id, last_rr_index)
+                    SELECT 1, CASE WHEN COUNT(*) > 0 THEN MOD(COUNT(*) - 1, %s) ELSE -1 END FROM temp_rr_table
+                    ON CONFLICT (id) DO UPDATE SET last_rr_index = EXCLUDED.last_rr_index;
+                """, (numberofpartitions,))
+                await conn.execute("DROP TABLE temp_rr_table;")
+                await _refresh_partition_stats(conn, 'rrobin_part', table_names if stats else [])
+                await conn.execute("SELECT pg_notify(%s, %s);", (LAYOUT_CHANNEL, 'rrobin_part'))
+                await conn.commit()
+            span.mark('fill')
+            invalidate_partition_layout('rrobin_part')
+            counts = [cur.rowcount for cur in fills]
+            span.finish(sum(counts))
+            return counts
+        except Exception as e:
+            span.fail()
+            await conn.rollback()
+            print(f"Error in roundrobin partition: {e}")
+            raise
+
+async def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
+    span = Metrics.span('async_rangeinsert')
+    async with _connection(openconnection) as conn:
+        try:
+            layout = await get_partition_layout('range_part', conn)
+            if not layout.table_names:
+                raise Exception("No range partitions found in metadata")
+            span.mark('layout')
+            async with conn.pipeline():
+                await conn.execute(
+                    f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES (%s, %s, %s);",
+                    (userid, itemid, rating)
+                )
+                table_name = layout.table_names[_range_index(rating, layout.ends)]
+                if not layout.native:
+                    await conn.execute(
+                        f"INSERT INTO {table_name} (userid, movieid, rating) VALUES (%s, %s, %s);",
+                        (userid, itemid, rating)
+                    )
+                if layout.stats:
+                    await _add_partition_stats(conn, table_name, rating)
+                await conn.commit()
+            span.mark('commit')
+            span.finish(1)
+        except Exception as e:
+            span.fail()
+            await conn.rollback()
+            _reset_layout_cache(conn)
+            print(f"Error in rangeinsert: {e}")
+            raise
+
+def _roundrobin_insert_sql(ratingstablename, table_names, stats=False):
+    """One statement that takes the next slot from rr_index_tracker and writes
+    the row to ratings, to the partition owning that slot and, with `stats`,
+    to its partition_stats row.
+
+    Every partition gets a data-modifying CTE filtered on the slot, so the
+    routing happens on the server and needs no extra round trip. If the
+    tracker row is missing nothing is written and no row is returned.
+    """
+    key = (ratingstablename, tuple(table_names), stats)
+    sql = _rr_insert_sql.get(key)
+    if sql is None:
+        row = "%(userid)s, %(movieid)s, %(rating)s"
+        ctes = [f"""slot AS (
+                UPDATE rr_index_tracker SET last_rr_index = MOD(last_rr_index + 1, {len(table_names)})
+                WHERE id = 1 RETURNING last_rr_index AS i
+            )"""]
+        for i, table_name in enumerate(table_names):
+            ctes.append(f"p{i} AS (INSERT INTO {table_name} (userid, movieid, rating) SELECT {row} FROM slot WHERE i = {i})")
+        if stats:
+            ctes.append(f"""stats AS (
+                INSERT INTO partition_stats
+                    (partition_table_name, row_count, rating_sum, rating_sumsq, rating_min, rating_max)
+                SELECT (%(tables)s::VARCHAR[])[i + 1], 1, %(rating)s, %(rating)s * %(rating)s, %(rating)s, %(rating)s
+                FROM slot {_STATS_UPSERT}
+            )""")
+        sql = _rr_insert_sql[key] = (
+            f"WITH {', '.join(ctes)} "
+            f"INSERT INTO {ratingstablename} (userid, movieid, rating) SELECT {row} FROM slot "
+            f"RETURNING (SELECT i FROM slot);"
+        )
+    return sql
+
+async def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
+    span = Metrics.span('async_roundrobininsert')
+    async with _connection(openconnection) as conn:
+        try:
+            layout = await get_partition_layout('rrobin_part', conn)
+            if not layout.table_names:
+                raise Exception("No roundrobin partitions found in metadata")
+            span.mark('layout')
+            params = {'userid': userid, 'movieid': itemid, 'rating': rating}
+            async with conn.pipeline():
+                if layout.native:
+                    cur = None
+                    await conn.execute(
+                        f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES (%(userid)s, %(movieid)s, %(rating)s);",
+                        params
+                    )
+                else:
+                    if layout.stats:
+                        params['tables'] = list(layout.table_names)
+                    cur = await conn.execute(
+                        _roundrobin_insert_sql(ratingstablename, layout.table_names, layout.stats), params
+                    )
+                await conn.commit()
+            span.mark('commit')
+            if cur is not None and await cur.fetchone() is None:
+                raise Exception("rr_index_tracker is not initialised")
+            span.finish(1)
+        except Exception as e:
+            span.fail()
+            await conn.rollback()
+            _reset_layout_cache(conn)
+            print(f"Error in roundrobininsert: {e}")
+            raise
+
+async def _load_partition_layout(prefix, conn):
+    if prefix == 'range_part':
+        cur = await conn.execute("""
+            SELECT partition_table_name, range_start, range_end
+            FROM range_metadata ORDER BY partition_id;
+        """)
+    elif prefix == 'rrobin_part':
+        cur = await conn.execute("""
+            SELECT partition_table_name, NULL, NULL
+            FROM roundrobin_metadata ORDER BY partition_id;
+        """)
+    else:
+        raise ValueError(f"Unknown partition prefix: {prefix}")
+    rows = await cur.fetchall()
+    native = False
+    stats = False
+    if rows:
+        cur = await conn.execute("""
+            SELECT relispartition, to_regclass('partition_stats') IS NOT NULL
+            FROM pg_class WHERE oid = to_regclass(%s);
+        """, (rows[0][0],))
+        row = await cur.fetchone()
+        native = bool(row and row[0])
+        if row and row[1]:
+            cur = await conn.execute("SELECT EXISTS (SELECT 1 FROM partition_stats WHERE partition_table_name = %s);",
+                                     (rows[0][0],))
+            stats = (await cur.fetchone())[0]
+    starts = [r[1] for r in rows] if prefix == 'range_part' else None
+    ends = [r[2] for r in rows] if prefix == 'range_part' else None
+    return PartitionLayout([r[0] for r in rows], starts, ends, native, stats=stats)
+
+def _on_notify(wconn, notify):
+    conn = wconn()
+    cache = _layout_cache.get(conn) if conn is not None else None
+    if cache is not None and notify.channel == LAYOUT_CHANNEL:
+        cache.pop(notify.payload, None)
+
+async def _poll_layout_changes(conn):
+    # Thông báo nhận được trong lúc chạy lệnh đã qua _on_notify; ở đây chỉ đọc phần còn nằm trên socket.
+    # Giữ khóa của kết nối để không đọc lẫn kết quả của task khác, và giao mọi thông báo cho
+    # notify_handler của psycopg: kênh khác vẫn tới add_notify_handler / conn.notifies()
+    async with conn.lock:
+        pgconn = conn.pgconn
+        if pgconn.pipeline_status != psycopg.pq.PipelineStatus.OFF:
+            return
+        pgconn.consume_input()
+        while (notify := pgconn.notifies()) is not None:
+            if pgconn.notify_handler:
+                pgconn.notify_handler(notify)
+
+async def get_partition_layout(prefix, conn):
+    """Async counterpart of Interface.get_partition_layout for one AsyncConnection."""
+    cache = _layout_cache.get(conn)
+    if cache is None:
+        cache = _layout_cache[conn] = {}
+        if conn not in _listening:
+            conn.add_notify_handler(lambda notify, wconn=weakref.ref(conn): _on_notify(wconn, notify))
+            _listening.add(conn)
+        await conn.execute(f"LISTEN {LAYOUT_CHANNEL};")
+    else:
+        await _poll_layout_changes(conn)
+    layout = cache.get(prefix)
+    if layout is None:
+        layout = cache[prefix] = await _load_partition_layout(prefix, conn)
+    return layout
+
+def _reset_layout_cache(conn):
+    # Rollback cũng hủy lệnh LISTEN chưa commit
+    _layout_cache.pop(conn, None)
+
+def invalidate_partition_layout(prefix=None):
+    for cache in list(_layout_cache.values()):
+        if prefix is None:
+            cache.clear()
+        else:
+            cache.pop(prefix, None)
@@ -0,0 +1,340 @@
+#
+# Benchmarks for the partitioning Interface
+#
+DATABASE_NAME = 'dds_bench'
+
+RATINGS_TABLE = 'ratings'
+RROBIN_TABLE_PREFIX = 'rrobin_part'
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+import traceback
+import psycopg2
+import Metrics
+import Interface as MyAssignment
+
+# Các mức nửa sao 0.5..5 như MovieLens
+RATING_VALUES = [i / 2.0 for i in range(1, 11)]
+
+
+def setuproundrobin(openconnection, numberofpartitions):
+    with openconnection.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS {0} CASCADE".format(RATINGS_TABLE))
+        cur.execute("CREATE TABLE {0} (userid INTEGER, movieid INTEGER, rating FLOAT)".format(RATINGS_TABLE))
+    openconnection.commit()
+    MyAssignment.roundrobinpartition(RATINGS_TABLE, numberofpartitions, openconnection)
+
+
+def roundrobinwriter(dbname, writerid, inserts, blocksize, barrier, errors):
+    conn = MyAssignment.getopenconnection(dbname=dbname)
+    allocator = MyAssignment.RoundRobinSlotAllocator(conn, blocksize) if blocksize > 0 else None
+    try:
+        barrier.wait()
+        for i in range(inserts):
+            MyAssignment.roundrobininsert(RATINGS_TABLE, writerid, i, (i % 10 + 1) / 2.0, conn, allocator=allocator)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        if allocator:
+            allocator.close()
+        conn.close()
+
+
+def benchmarkroundrobinwriters(dbname, openconnection, writercounts, insertsperwriter, numberofpartitions=5, blocksize=64):
+    """
+    Stress roundrobininsert with concurrent writers, one connection per writer thread.
+    :param blocksize: slots reserved per RoundRobinSlotAllocator block, 0 to lock rr_index_tracker on every insert
+    :return: one result dict per writer count with inserts/s and the per-partition distribution
+    """
+    results = []
+    for writers in writercounts:
+        setuproundrobin(openconnection, numberofpartitions)
+        barrier = threading.Barrier(writers + 1)
+        errors = []
+        threads = [threading.Thread(target=roundrobinwriter,
+                                    args=(dbname, w, insertsperwriter, blocksize, barrier, errors))
+                   for w in range(writers)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for t in threads:
+                t.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+
+        with openconnection.cursor() as cur:
+            counts = []
+            for i in range(numberofpartitions):
+                cur.execute("SELECT COUNT(*) FROM {0}{1}".format(RROBIN_TABLE_PREFIX, i))
+                counts.append(int(cur.fetchone()[0]))
+        total = writers * insertsperwriter
+        # Mỗi writer có thể bỏ dở tối đa một block, làm lệch tối đa ceil((blocksize-1)/n) dòng mỗi partition
+        allowedspread = 1 + (writers * -(-(blocksize - 1) // numberofpartitions) if blocksize > 0 else 0)
+        spread = max(counts) - min(counts)
+        results.append({
+            'writers': writers,
+            'blocksize': blocksize,
+            'inserts': total,
+            'seconds': elapsed,
+            'inserts_per_second': total / elapsed if elapsed > 0 else 0.0,
+            'partition_counts': counts,
+            'complete': sum(counts) == total,
+            'balanced': spread <= allowedspread,
+        })
+    return results
+
+
+def generateratingsfile(path, rows, seed=0, skew=0.0, users=None, movies=10000):
+    """
+    Write a deterministic MovieLens-style ``userid::movieid::rating::timestamp`` file.
+    :param skew: 0 for uniform half-star ratings, > 0 biases toward high ratings, < 0 toward low ones
+    :return: the number of lines written
+    """
+    rng = random.Random(seed)
+    weights = [(k + 1) ** skew for k in range(len(RATING_VALUES))]
+    users = users or max(1, rows // 100)
+    written = 0
+    with open(path, 'w') as f:
+        for userid in range(1, users + 1):
+            # Chia đều số dòng cho các user, user cuối nhận phần dư; movieid không trùng trong một user
+            remaining = rows - written
+            count = remaining if userid == users else min(remaining, rows // users)
+            count = min(count, movies)
+            movieids = sorted(rng.sample(range(1, movies + 1), count))
+            ratings = rng.choices(RATING_VALUES, weights, k=count)
+            lines = [f"{userid}::{m}::{r:g}::{838985046 + written + j}\n"
+                     for j, (m, r) in enumerate(zip(movieids, ratings))]
+            f.writelines(lines)
+            written += count
+            if written >= rows:
+                break
+    return written
+
+
+def droptable(openconnection, tablename):
+    with openconnection.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS {0} CASCADE".format(tablename))
+    openconnection.commit()
+
+
+def dropdb(dbname):
+    con = MyAssignment.getopenconnection(dbname='postgres')
+    try:
+        con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with con.cursor() as cur:
+            cur.execute("DROP DATABASE IF EXISTS {0}".format(dbname))
+    finally:
+        con.close()
+
+
+def timed(function, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return time.perf_counter() - start, result
+
+
+def benchmarkloadratings(openconnection, ratingsfilepath, rows, workercounts=(1,), repeat=1):
+    results = []
+    for workers in workercounts:
+        for _ in range(repeat):
+            elapsed, _ = timed(MyAssignment.loadratings, RATINGS_TABLE, ratingsfilepath, openconnection, workers=workers)
+            results.append({
+                'workers': workers,
+                'rows': rows,
+                'seconds': elapsed,
+                'rows_per_second': rows / elapsed if elapsed > 0 else 0.0,
+            })
+    return results
+
+
+def benchmarkpartitioners(openconnection, ratingsfilepath, rows, partitioncounts, repeat=1):
+    """Time rangepartition and roundrobinpartition over the same loaded ratings table."""
+    timed(MyAssignment.loadratings, RATINGS_TABLE, ratingsfilepath, openconnection)
+    results = []
+    for numberofpartitions in partitioncounts:
+        for name, partition in (('rangepartition', MyAssignment.rangepartition),
+                                ('roundrobinpartition', MyAssignment.roundrobinpartition)):
+            for _ in range(repeat):
+                elapsed, counts = timed(partition, RATINGS_TABLE, numberofpartitions, openconnection)
+                results.append({
+                    'function': name,
+                    'partitions': numberofpartitions,
+                    'rows': rows,
+                    'seconds': elapsed,
+                    'rows_per_second': rows / elapsed if elapsed > 0 else 0.0,
+                    'complete': sum(counts) == rows,
+                })
+    return results
+
+
+def benchmarkinserts(openconnection, ratingsfilepath, partitioncounts, inserts, batchsize=1000, seed=0):
+    """Single-row rangeinsert/roundrobininsert against their batched _many variants.
+    Ratings and partitions are rebuilt before every measurement so each run starts from the same state."""
+    rng = random.Random(seed)
+    rows = [(rng.randint(1, 100000), rng.randint(1, 10000), rng.choice(RATING_VALUES)) for _ in range(inserts)]
+    batches = [rows[i:i + batchsize] for i in range(0, len(rows), batchsize)]
+
+    def single(insert):
+        for userid, movieid, rating in rows:
+            insert(RATINGS_TABLE, userid, movieid, rating, openconnection)
+
+    def batched(insertmany):
+        for batch in batches:
+            insertmany(RATINGS_TABLE, batch, openconnection)
+
+    cases = (
+        ('rangeinsert', MyAssignment.rangepartition, lambda: single(MyAssignment.rangeinsert)),
+        ('rangeinsert_many', MyAssignment.rangepartition, lambda: batched(MyAssignment.rangeinsert_many)),
+        ('roundrobininsert', MyAssignment.roundrobinpartition, lambda: single(MyAssignment.roundrobininsert)),
+        ('roundrobininsert_many', MyAssignment.roundrobinpartition, lambda: batched(MyAssignment.roundrobininsert_many)),
+    )
+    results = []
+    for numberofpartitions in partitioncounts:
+        for name, partition, run in cases:
+            timed(MyAssignment.loadratings, RATINGS_TABLE, ratingsfilepath, openconnection)
+            timed(partition, RATINGS_TABLE, numberofpartitions, openconnection)
+            elapsed, _ = timed(run)
+            results.append({
+                'function': name,
+                'partitions': numberofpartitions,
+                'inserts': inserts,
+                'batchsize': batchsize if name.endswith('_many') else 1,
+                'seconds': elapsed,
+                'inserts_per_second': inserts / elapsed if elapsed > 0 else 0.0,
+            })
+    return results
+
+
+def runsuite(rows=100000, seed=0, skew=0.0, partitioncounts=(5,), loadworkers=(1,), inserts=1000,
+             batchsize=1000, repeat=1, dbname=None, ratingsfilepath=None, keepdb=False):
+    """
+    Run the whole benchmark suite in a throwaway database (dropped afterwards unless keepdb).
+    :param ratingsfilepath: existing ratings file to use, otherwise a synthetic one is generated and removed
+    :return: a JSON-serialisable dict with the parameters, environment and every result
+    """
+    dbname = dbname or '{0}_{1}'.format(DATABASE_NAME, os.getpid())
+    generated = ratingsfilepath is None
+    if generated:
+        fd, ratingsfilepath = tempfile.mkstemp(prefix='ratings_', suffix='.dat')
+        os.close(fd)
+        rows = generateratingsfile(ratingsfilepath, rows, seed, skew)
+    else:
+        with open(ratingsfilepath, 'rb') as f:
+            rows = sum(1 for _ in f)
+
+    wasenabled = Metrics.enabled()
+    Metrics.reset()
+    Metrics.enable()
+    with contextlib.redirect_stdout(io.StringIO()):
+        MyAssignment.create_db(dbname)
+    conn = MyAssignment.getopenconnection(dbname=dbname)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SHOW server_version")
+            serverversion = cur.fetchone()[0]
+        report = {
+            'parameters': {
+                'rows': rows, 'seed': seed, 'skew': skew, 'generated': generated,
+                'partition_counts': list(partitioncounts), 'load_workers': list(loadworkers),
+                'inserts': inserts, 'batchsize': batchsize, 'repeat': repeat,
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'server_version': serverversion,
+            },
+            'loadratings': benchmarkloadratings(conn, ratingsfilepath, rows, loadworkers, repeat),
+            'partitioners': benchmarkpartitioners(conn, ratingsfilepath, rows, partitioncounts, repeat),
+            'inserts': benchmarkinserts(conn, ratingsfilepath, partitioncounts, inserts, batchsize, seed),
+            'metrics': Metrics.snapshot()['operations'],
+        }
+    finally:
+        conn.close()
+        if not wasenabled:
+            Metrics.disable()
+        if not keepdb:
+            dropdb(dbname)
+        if generated:
+            os.remove(ratingsfilepath)
+    return report
+
+
+def intlist(value):
+    return [int(v) for v in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the partitioning Interface')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    writers = commands.add_parser('writers', help='concurrent round robin insert stress benchmark')
+    writers.add_argument('--dbname', default=DATABASE_NAME)
+    writers.add_argument('--writers', default='1,2,4,8', help='comma separated writer counts')
+    writers.add_argument('--inserts', type=int, default=500, help='inserts per writer')
+    writers.add_argument('--partitions', type=int, default=5)
+    writers.add_argument('--blocksize', type=int, default=64)
+    writers.add_argument('--output', help='write results as JSON to this file')
+
+    suite = commands.add_parser('suite', help='load/partition/insert throughput in a throwaway database')
+    suite.add_argument('--rows', type=int, default=100000, help='rows in the synthetic ratings file')
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--skew', type=float, default=0.0, help='0 uniform, > 0 toward high ratings, < 0 toward low')
+    suite.add_argument('--partitions', default='2,5,10', help='comma separated partition counts')
+    suite.add_argument('--load-workers', default='1', help='comma separated loadratings worker counts')
+    suite.add_argument('--inserts', type=int, default=1000, help='rows inserted per insert benchmark')
+    suite.add_argument('--batchsize', type=int, default=1000)
+    suite.add_argument('--repeat', type=int, default=1)
+    suite.add_argument('--ratings', help='use this ratings file instead of generating one')
+    suite.add_argument('--dbname', help='database to create (default dds_bench_<pid>)')
+    suite.add_argument('--keep-db', action='store_true')
+    suite.add_argument('--output', default='benchmark_results.json', help='write results as JSON to this file')
+
+    generate = commands.add_parser('generate', help='write a synthetic ratings file')
+    generate.add_argument('path')
+    generate.add_argument('--rows', type=int, default=100000)
+    generate.add_argument('--seed', type=int, default=0)
+    generate.add_argument('--skew', type=float, default=0.0)
+
+    args = parser.parse_args()
+    try:
+        if args.command == 'generate':
+            print("{0} rows written to {1}".format(generateratingsfile(args.path, args.rows, args.seed, args.skew), args.path))
+        elif args.command == 'suite':
+            report = runsuite(args.rows, args.seed, args.skew, intlist(args.partitions), intlist(args.load_workers),
+                              args.inserts, args.batchsize, args.repeat, args.dbname, args.ratings, args.keep_db)
+            for r in report['loadratings']:
+                print("loadratings workers={workers}: {rows_per_second:.0f} rows/s".format(**r))
+            for r in report['partitioners']:
+                print("{function} partitions={partitions}: {rows_per_second:.0f} rows/s, complete={complete}".format(**r))
+            for r in report['inserts']:
+                print("{function} partitions={partitions} batchsize={batchsize}: {inserts_per_second:.0f} inserts/s".format(**r))
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            MyAssignment.create_db(args.dbname)
+            conn = MyAssignment.getopenconnection(dbname=args.dbname)
+            try:
+                results = benchmarkroundrobinwriters(args.dbname, conn, intlist(args.writers),
+                                                     args.inserts, args.partitions, args.blocksize)
+            finally:
+                conn.close()
+            for r in results:
+                print("writers={writers} blocksize={blocksize}: {inserts_per_second:.0f} inserts/s, "
+                      "counts={partition_counts}, complete={complete}, balanced={balanced}".format(**r))
+            if args.output:
+                with open(args.output, 'w') as f:
+                    json.dump(results, f, indent=2)
+    except Exception:
+        traceback.print_exc()
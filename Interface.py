@@ -1,6 +1,58 @@
 import psycopg2
 import psycopg2.extensions
+import heapq
+import io
+import json
+import math
+import os
+import struct
 import time
+import tempfile
+import weakref
+import zlib
+from itertools import count as _counter
+from bisect import bisect_left
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import Metrics
+
+# Kích thước tối đa (bytes) giữ trong RAM cho mỗi partition khi chia một lượt,
+# vượt quá sẽ tràn ra file tạm
+SPOOL_MAX_BYTES = 32 * 1024 * 1024
+# Kiểu cột rating: FLOAT (8 byte) mặc định, REAL (4 byte) ở chế độ compact.
+# Mọi mức nửa sao 0.5..5 đều biểu diễn chính xác bằng REAL nên thành viên partition không đổi.
+RATING_TYPE = 'FLOAT'
+COMPACT_RATING_TYPE = 'REAL'
+
+# Kích thước mỗi khối dữ liệu gửi cho COPY khi nạp file ratings
+COPY_CHUNK_BYTES = 1024 * 1024
+# Kênh LISTEN/NOTIFY báo bố cục partition vừa được xây lại
+LAYOUT_CHANNEL = 'partition_layout'
+# Bảng đánh số dùng chung của roundrobinpartition song song (tên thật: build_rr_numbered)
+RR_NUMBERED_TABLE = 'rr_numbered'
+
+# native=True khi các partition là partition khai báo (declarative) của chính bảng ratings;
+# ring = (tokens đã sắp xếp, bảng sở hữu từng token) và key chỉ dùng cho hash partition;
+# stats=True khi partition_stats đang được duy trì cho bố cục này
+PartitionLayout = namedtuple('PartitionLayout', ['table_names', 'starts', 'ends', 'native', 'ring', 'key', 'stats'],
+                             defaults=(None, None, False))
+
+# connection -> {prefix: PartitionLayout}
+_layout_cache = weakref.WeakKeyDictionary()
+
+# Số điểm ảo của mỗi hash partition trên vòng băm nhất quán
+HASH_VNODES = 256
+HASH_KEYS = ('userid', 'movieid')
+
+# Bảng metadata đi kèm snapshot; prefix partition mà từng bảng metadata mô tả
+SNAPSHOT_METADATA_TABLES = ('range_metadata', 'roundrobin_metadata', 'rr_index_tracker',
+                            'hash_metadata', 'hash_ring', 'partition_stats')
+SNAPSHOT_LAYOUTS = {'range_metadata': 'range_part', 'roundrobin_metadata': 'rrobin_part', 'hash_metadata': 'hash_part'}
+SNAPSHOT_MANIFEST = 'manifest.json'
+
+# Số dòng lấy về mỗi lần FETCH từ server-side cursor
+QUERY_ITERSIZE = 10000
+_cursor_ids = _counter()
 
 def getopenconnection(user='postgres', password='123456', dbname='postgres'):
     try:
@@ -38,35 +90,131 @@ def create_db(dbname, user='postgres', password='123456'):
         if con:
             con.close()
 
-def loadratings(ratingstablename, ratingsfilepath, openconnection):
-    start = time.time()
+class _RatingsFileReader:
+    """File-like source for COPY FROM that streams `userid::movieid::rating::timestamp`
+    lines and yields only tab-separated `userid, movieid, rating` rows.
+
+    When `end` is given, only lines starting before that byte offset are read.
+    """
+
+    def __init__(self, f, end=None):
+        self.f = f
+        self.end = end
+        self.rows = 0
+        self.bytes = 0
+        self._buffer = bytearray()
+
+    def _next_row(self):
+        while True:
+            if self.end is not None and self.f.tell() >= self.end:
+                return b''
+            raw = self.f.readline()
+            if not raw:
+                return b''
+            self.bytes += len(raw)
+            line = raw.rstrip(b'\r\n')
+            if not line:
+                continue
+            fields = line.split(b'::', 3)
+            self.rows += 1
+            return b'\t'.join(fields[:3]) + b'\n'
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            row = self._next_row()
+            if not row:
+                break
+            self._buffer += row
+        if size < 0:
+            size = len(self._buffer)
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return chunk
+
+def _file_ranges(ratingsfilepath, workers):
+    size = os.path.getsize(ratingsfilepath)
+    step = max(1, -(-size // workers))
+    return [(begin, min(begin + step, size)) for begin in range(0, size, step)]
+
+def _copy_ratings_range(cur, ratingstablename, ratingsfilepath, begin=0, end=None):
+    with open(ratingsfilepath, 'rb') as f:
+        if begin > 0:
+            # Bỏ qua phần cuối dòng đang dở, dòng đó thuộc về khoảng phía trước
+            f.seek(begin - 1)
+            f.readline()
+        reader = _RatingsFileReader(f, end)
+        cur.copy_expert(
+            f"COPY {ratingstablename} (userid, movieid, rating) FROM STDIN",
+            reader,
+            size=COPY_CHUNK_BYTES,
+        )
+        return reader.rows, reader.bytes
+
+def _load_worker(openconnection, ratingstablename, ratingsfilepath, begin, end):
+    con = _open_worker_connection(openconnection)
     cur = None
     try:
-        cur = openconnection.cursor()
+        cur = con.cursor()
+        result = _copy_ratings_range(cur, ratingstablename, ratingsfilepath, begin, end)
+        con.commit()
+        return result
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        if cur:
+            cur.close()
+        con.close()
+
+def loadratings(ratingstablename, ratingsfilepath, openconnection, workers=1, compact=False):
+    span = Metrics.span('loadratings')
+    start = time.perf_counter()
+    cur = None
+    try:
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
         cur.execute(f"DROP TABLE IF EXISTS {ratingstablename} CASCADE;")
         cur.execute(f"""
             CREATE TABLE {ratingstablename} (
                 userid INTEGER,
-                extra1 CHAR,
                 movieid INTEGER,
-                extra2 CHAR,
-                rating FLOAT,
-                extra3 CHAR,
-                timestamp BIGINT
+                rating {COMPACT_RATING_TYPE if compact else RATING_TYPE}
             );
         """)
-        with open(ratingsfilepath, 'r') as f:
-            cur.copy_from(f, ratingstablename, sep=':')
-        cur.execute(f"""
-            ALTER TABLE {ratingstablename}
-            DROP COLUMN extra1,
-            DROP COLUMN extra2,
-            DROP COLUMN extra3,
-            DROP COLUMN timestamp;
-        """)
-        openconnection.commit()
-        print(f"[TIME]Data loaded into {ratingstablename} in {time.time() - start:.2f} seconds.")
+        span.mark('drop_create')
+        if workers > 1:
+            # Bảng phải được commit trước để các kết nối worker nhìn thấy
+            span.commit(openconnection)
+            ranges = _file_ranges(ratingsfilepath, workers)
+            try:
+                # File rỗng không có khoảng nào: pool vẫn cần ít nhất một worker
+                with ThreadPoolExecutor(max_workers=max(1, len(ranges))) as pool:
+                    results = list(pool.map(
+                        lambda r: _load_worker(openconnection, ratingstablename, ratingsfilepath, r[0], r[1]),
+                        ranges,
+                    ))
+            except Exception:
+                cur.execute(f"DROP TABLE IF EXISTS {ratingstablename} CASCADE;")
+                span.commit(openconnection)
+                raise
+        else:
+            results = [_copy_ratings_range(cur, ratingstablename, ratingsfilepath)]
+        span.mark('fill')
+        span.commit(openconnection)
+        span.mark('commit')
+
+        elapsed = time.perf_counter() - start
+        rows = sum(r[0] for r in results)
+        megabytes = sum(r[1] for r in results) / (1024 * 1024)
+        stats = {
+            'rows': rows,
+            'seconds': elapsed,
+            'rows_per_second': rows / elapsed if elapsed > 0 else 0.0,
+            'mb_per_second': megabytes / elapsed if elapsed > 0 else 0.0,
+        }
+        span.finish(rows)
+        return stats
     except Exception as e:
+        span.fail()
         if openconnection:
             openconnection.rollback()
         print(f"Error loading ratings: {e}")
@@ -75,6 +223,27 @@ def loadratings(ratingstablename, ratingsfilepath, openconnection):
         if cur:
             cur.close()
 
+def compacttable(tablename, openconnection):
+    """Rewrite an existing ratings/partition table to the compact layout:
+    rating becomes REAL and the table rewrite also reclaims the space of
+    columns dropped by the old 7-column loader."""
+    span = Metrics.span('compacttable')
+    cur = None
+    try:
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        cur.execute(f"ALTER TABLE {tablename} ALTER COLUMN rating TYPE {COMPACT_RATING_TYPE};")
+        span.commit(openconnection)
+        span.finish()
+    except Exception as e:
+        span.fail()
+        if openconnection:
+            openconnection.rollback()
+        print(f"Error compacting {tablename}: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
 def create_range_partition_metadata_table(openconnection):
     cur = None
     try:
@@ -95,100 +264,714 @@ def create_range_partition_metadata_table(openconnection):
         if cur:
             cur.close()
 
-def rangepartition(ratingstablename, numberofpartitions, openconnection):
-    import time
-    start = time.time()
+def _range_bounds(numberofpartitions, boundaries=None):
+    if boundaries is not None:
+        # Biên tùy chọn [b0, b1, ..., bn]: partition i nhận khoảng (b_i, b_i+1]
+        if len(boundaries) != numberofpartitions + 1:
+            raise ValueError("Expected numberofpartitions + 1 boundaries.")
+        if any(lo > hi for lo, hi in zip(boundaries, boundaries[1:])):
+            raise ValueError("Boundaries must be sorted in ascending order.")
+        return list(zip(boundaries, boundaries[1:]))
+    delta = 5.0 / numberofpartitions
+    bounds = []
+    for i in range(numberofpartitions):
+        minRange = round(i * delta, 6)
+        maxRange = round(minRange + delta, 6)
+        bounds.append((minRange, maxRange))
+    return bounds
+
+def _balanced_cuts(values, counts, numberofpartitions):
+    """Split the sorted distinct `values` (with row `counts`) into at most
+    numberofpartitions consecutive groups so that the largest group is as
+    small as possible, and return the last value of every group but the
+    final one. Every group is non-empty, so there are fewer cuts only when
+    there are fewer distinct values than partitions."""
+    groups = min(numberofpartitions, len(values))
+    if groups <= 1:
+        return []
+
+    def needed(limit):
+        parts, load = 1, 0
+        for count in counts:
+            if load + count > limit:
+                parts, load = parts + 1, 0
+            load += count
+        return parts
+
+    # Tải lớn nhất nhỏ nhất: tìm nhị phân trên tổng số dòng, mỗi lần kiểm tra bằng một lượt tham lam
+    lo, hi = max(counts), sum(counts)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if needed(mid) <= groups:
+            hi = mid
+        else:
+            lo = mid + 1
+
+    # Dồn tham lam nhưng chừa đủ giá trị để mọi nhóm còn lại đều không rỗng
+    cuts, load = [], 0
+    for i, count in enumerate(counts):
+        remaining_values = len(values) - i
+        remaining_groups = groups - len(cuts)
+        if load and (load + count > lo or remaining_values < remaining_groups):
+            cuts.append(values[i - 1])
+            load = 0
+        load += count
+    return cuts
+
+def compute_equidepth_boundaries(ratingstablename, numberofpartitions, openconnection, samplepercent=None):
+    """Return numberofpartitions + 1 boundaries over [0, 5] that balance the
+    rows across the partitions. Cut points are placed between distinct
+    rating values from a histogram of the table (or of a TABLESAMPLE of
+    `samplepercent` percent), minimising the largest partition; they are
+    strictly increasing unless there are fewer distinct ratings than
+    partitions, in which case the surplus partitions are left empty."""
     cur = None
     try:
         if numberofpartitions <= 0:
             raise ValueError("Number of partitions must be greater than 0.")
+        cur = openconnection.cursor()
+        sample = f" TABLESAMPLE SYSTEM ({float(samplepercent)})" if samplepercent else ""
+        cur.execute(f"""
+            SELECT rating, COUNT(*) FROM {ratingstablename}{sample}
+            WHERE rating IS NOT NULL GROUP BY rating ORDER BY rating;
+        """)
+        histogram = cur.fetchall()
+        values = [float(r[0]) for r in histogram]
+        counts = [r[1] for r in histogram]
+        cuts = _balanced_cuts(values, counts, numberofpartitions)
+        cuts = [min(max(c, 0.0), 5.0) for c in cuts]
+        cuts += [5.0] * (numberofpartitions - 1 - len(cuts))
+        return [0.0] + cuts + [5.0]
+    finally:
+        if cur:
+            cur.close()
+
+def _range_router(bounds):
+    # Partition 0 lấy cả hai đầu [start, end], các partition khác nửa mở (start, end]
+    starts = [b[0] for b in bounds]
+    ends = [b[1] for b in bounds]
+    n = len(bounds)
+
+    def route(line):
+        value = line.rsplit('\t', 1)[1]
+        if value == '\\N':
+            return None
+        rating = float(value)
+        index = bisect_left(ends, rating)
+        if index >= n:
+            return None
+        if rating > starts[index] or (index == 0 and rating >= starts[0]):
+            return index
+        return None
+
+    return route
+
+class _CopyRouter:
+    """File-like target for COPY ... TO STDOUT that fans every row out to a
+    per-partition spool file, so the source table is read exactly once."""
+
+    def __init__(self, numberofpartitions, route, stats=False, real=False):
+        self.route = route
+        self.counts = [0] * numberofpartitions
+        # [sum, sumsq, min, max] của rating từng partition, chỉ tính khi cần ghi partition_stats
+        self.stats = [[0.0, 0.0, None, None] for _ in range(numberofpartitions)] if stats else None
+        self.real = real
+        self.spools = [
+            tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, mode='w+')
+            for _ in range(numberofpartitions)
+        ]
+        self._tail = ''
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        lines = (self._tail + data).split('\n')
+        self._tail = lines.pop()
+        for line in lines:
+            index = self.route(line)
+            if index is not None:
+                self.spools[index].write(line)
+                self.spools[index].write('\n')
+                self.counts[index] += 1
+                if self.stats is not None:
+                    self._observe(index, line)
+        return len(data)
+
+    def _observe(self, index, line):
+        value = line.rsplit('\t', 1)[1]
+        if value == '\\N':
+            return
+        rating = float(value)
+        if self.real:
+            # Giữ đúng giá trị REAL mà bảng lưu, như MIN/MAX trên server trả về
+            rating = struct.unpack('<f', struct.pack('<f', rating))[0]
+        s = self.stats[index]
+        s[0] += rating
+        s[1] += rating * rating
+        if s[2] is None or rating < s[2]:
+            s[2] = rating
+        if s[3] is None or rating > s[3]:
+            s[3] = rating
 
+    def partition_stats(self, table_names):
+        # Cùng dạng với một dòng partition_stats: name -> (count, sum, sumsq, min, max)
+        if self.stats is None:
+            return {}
+        return {t: (c,) + tuple(s) for t, c, s in zip(table_names, self.counts, self.stats)}
+
+    def copy_into(self, cur, table_names):
+        for table_name, spool in zip(table_names, self.spools):
+            spool.seek(0)
+            cur.copy_expert(f"COPY {table_name} (userid, movieid, rating) FROM STDIN", spool)
+        return self.counts
+
+    def close(self):
+        for spool in self.spools:
+            spool.close()
+
+def _fanout_copy(cur, selectquery, table_names, route, stats=False, real=False):
+    # Trả về (số dòng từng partition, thống kê từng partition nếu stats=True)
+    router = _CopyRouter(len(table_names), route, stats, real)
+    try:
+        cur.copy_expert(f"COPY ({selectquery}) TO STDOUT", router)
+        return router.copy_into(cur, table_names), router.partition_stats(table_names)
+    finally:
+        router.close()
+
+def _create_partition_table(cur, table_name, unlogged=False, like=None, compact=False):
+    # UNLOGGED bỏ qua WAL khi nạp, chỉ dùng cho bản dựng bulk không cần bền vững (durable=False).
+    # LIKE bảng nguồn để partition giữ đúng kiểu cột (kể cả rating REAL ở chế độ compact)
+    kind = "UNLOGGED TABLE" if unlogged else "TABLE"
+    if like:
+        cur.execute(f"CREATE {kind} {table_name} (LIKE {like});")
+    else:
+        rating_type = COMPACT_RATING_TYPE if compact else RATING_TYPE
+        cur.execute(f"CREATE {kind} {table_name} (userid INTEGER, movieid INTEGER, rating {rating_type});")
+
+def _finish_partition_tables(cur, table_names, indexes=None, bulk=False):
+    """Post-load steps of a bulk build: indexes are created only once the
+    data is in, then statistics are gathered.
+
+    Tables keep the persistence they were created with. A durable bulk build
+    creates LOGGED tables in the same transaction that fills them, which
+    under wal_level=minimal skips WAL for the load just like UNLOGGED;
+    switching UNLOGGED -> LOGGED afterwards would rewrite the heap and every
+    index. With a higher wal_level the load is WAL-logged, and only
+    durable=False (UNLOGGED, emptied after a crash) avoids that."""
+    for table_name in table_names:
+        for column in indexes or ():
+            cur.execute(f"CREATE INDEX {table_name}_{column}_idx ON {table_name} ({column});")
+        if bulk:
+            cur.execute(f"ANALYZE {table_name};")
+
+def _open_worker_connection(openconnection):
+    info = openconnection.info
+    return getopenconnection(user=info.user, password=info.password, dbname=info.dbname)
+
+def _build_table_name(table_name):
+    return f"build_{table_name}"
+
+def _drop_build_tables(openconnection, table_names):
+    cur = None
+    try:
         cur = openconnection.cursor()
+        for table_name in table_names:
+            cur.execute(f"DROP TABLE IF EXISTS {_build_table_name(table_name)};")
+        openconnection.commit()
+    finally:
+        if cur:
+            cur.close()
+
+def _build_worker(openconnection, jobs, unlogged=False, like=None):
+    con = _open_worker_connection(openconnection)
+    cur = None
+    try:
+        cur = con.cursor()
+        counts = {}
+        for table_name, selectquery, params in jobs:
+            build_name = _build_table_name(table_name)
+            cur.execute(f"DROP TABLE IF EXISTS {build_name};")
+            _create_partition_table(cur, build_name, unlogged, like)
+            cur.execute(f"INSERT INTO {build_name} (userid, movieid, rating) {selectquery};", params)
+            counts[table_name] = cur.rowcount
+            con.commit()
+        return counts
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        if cur:
+            cur.close()
+        con.close()
+
+def _parallel_build(openconnection, jobs, workers, unlogged=False, like=None):
+    """Fill one build_<partition> table per job over `workers` extra connections.
+
+    The build tables are swapped in by the caller inside its own transaction;
+    if any worker fails, every build table is dropped before re-raising.
+    """
+    groups = [jobs[i::workers] for i in range(min(workers, len(jobs)))]
+    counts = {}
+    try:
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            for result in pool.map(lambda group: _build_worker(openconnection, group, unlogged, like), groups):
+                counts.update(result)
+    except Exception:
+        _drop_build_tables(openconnection, [job[0] for job in jobs])
+        raise
+    return [counts[job[0]] for job in jobs]
+
+def _write_range_metadata(cur, table_names, bounds):
+    for table_name, (minRange, maxRange) in zip(table_names, bounds):
+        cur.execute("""
+            INSERT INTO range_metadata (partition_table_name, range_start, range_end)
+            VALUES (%s, %s, %s);
+        """, (table_name, minRange, maxRange))
+    _notify_layout_change(cur, 'range_part')
+
+def _nextafter_real(value):
+    # Số REAL (float32) nhỏ nhất lớn hơn value
+    value = float(value) + 0.0
+    bits = struct.unpack('<i', struct.pack('<f', value))[0]
+    rounded = struct.unpack('<f', struct.pack('<i', bits))[0]
+    if rounded > value:
+        return rounded
+    bits = bits + 1 if rounded >= 0 else bits - 1
+    return struct.unpack('<f', struct.pack('<i', bits))[0]
+
+def _rating_is_real(cur, ratingstablename):
+    cur.execute("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attname = 'rating';
+    """, (ratingstablename,))
+    row = cur.fetchone()
+    return bool(row and row[0] == 'real')
+
+def _real_rating_tables(cur, table_names):
+    # Các bảng trong table_names có cột rating kiểu REAL, trong một lượt truy vấn
+    cur.execute("""
+        SELECT t FROM unnest(%s::TEXT[]) AS t
+        JOIN pg_attribute ON attrelid = to_regclass(t) AND attname = 'rating'
+        WHERE format_type(atttypid, atttypmod) = 'real';
+    """, (list(table_names),))
+    return {r[0] for r in cur.fetchall()}
+
+def _native_range_clauses(bounds, real=False):
+    # Partition khai báo dùng [FROM, TO); dịch mỗi biên lên một ULP (của kiểu cột) để giữ quy tắc (start, end].
+    # Partition đầu/cuối mở tới MINVALUE/MAXVALUE để nhận cả giá trị ngoài miền, như _range_index
+    clauses = []
+    lower, previous = 'MINVALUE', -math.inf
+    for i, (minRange, maxRange) in enumerate(bounds):
+        if i == len(bounds) - 1:
+            upper = 'MAXVALUE'
+        else:
+            value = _nextafter_real(maxRange) if real else math.nextafter(maxRange, math.inf)
+            if previous >= value:
+                raise ValueError("Native range partitions need strictly increasing boundaries.")
+            previous, upper = value, repr(value)
+        clauses.append(f"FOR VALUES FROM ({lower}) TO ({upper})")
+        lower = upper
+    return clauses
+
+def _check_not_native(cur, table_names):
+    # Xóa một partition khai báo sẽ xóa luôn dữ liệu của nó khỏi bảng ratings
+    cur.execute("SELECT relname FROM pg_class WHERE relispartition AND relname = ANY(%s);", (list(table_names),))
+    row = cur.fetchone()
+    if row:
+        raise ValueError(f"{row[0]} is a declarative partition of the ratings table; rebuild it with native=True.")
+
+def _build_native_partitions(cur, ratingstablename, partitionby, table_names, clauses):
+    """Recreate `ratingstablename` as a declaratively partitioned parent with
+    one child per (table_name, bound clause), moving all existing rows into
+    it. Returns the row count of every child."""
+    old_name = f"{ratingstablename}_unpartitioned"
+    cur.execute("SELECT partstrat FROM pg_partitioned_table WHERE partrelid = to_regclass(%s);", (ratingstablename,))
+    row = cur.fetchone()
+    old_strategy = row[0] if row else None
+
+    cur.execute(f"DROP TABLE IF EXISTS {old_name} CASCADE;")
+    cur.execute(f"ALTER TABLE {ratingstablename} RENAME TO {old_name};")
+    # Nếu ratings đã được partition sẵn, đổi tên các partition cũ để nhường tên cho partition mới
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s);
+    """, (old_name,))
+    for (child,) in cur.fetchall():
+        cur.execute(f"ALTER TABLE {child} RENAME TO {child}_detached;")
+
+    cur.execute(f"CREATE TABLE {ratingstablename} (LIKE {old_name}) PARTITION BY {partitionby};")
+    for table_name, clause in zip(table_names, clauses):
+        cur.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE;")
+        cur.execute(f"CREATE TABLE {table_name} PARTITION OF {ratingstablename} {clause};")
+    cur.execute(f"INSERT INTO {ratingstablename} SELECT * FROM {old_name};")
+    cur.execute(f"DROP TABLE {old_name} CASCADE;")
+
+    # Partition khai báo của lược đồ còn lại (range <-> hash) đã bị xóa cùng bảng cũ
+    new_strategy = partitionby.split()[0][0].lower()
+    stale = {'r': ('range_metadata', 'range_part'), 'h': ('roundrobin_metadata', 'rrobin_part')}
+    if old_strategy and old_strategy != new_strategy and old_strategy in stale:
+        metadata_table, prefix = stale[old_strategy]
+        cur.execute(f"DELETE FROM {metadata_table};")
+        _notify_layout_change(cur, prefix)
+
+    cur.execute(f"SELECT tableoid::regclass::text, COUNT(*) FROM {ratingstablename} GROUP BY 1;")
+    found = dict(cur.fetchall())
+    return [found.get(table_name, 0) for table_name in table_names]
+
+def rangepartition(ratingstablename, numberofpartitions, openconnection, singlepass=False, workers=1,
+                   boundaries=None, native=False, bulk=False, indexes=None, durable=True, stats=False,
+                   samplepercent=None):
+    span = Metrics.span('rangepartition')
+    cur = None
+    table_names = []
+    known = {}
+    unlogged = bulk and not durable
+    try:
+        if numberofpartitions <= 0:
+            raise ValueError("Number of partitions must be greater than 0.")
+
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
         create_range_partition_metadata_table(openconnection)
 
-        cur.execute("DELETE FROM range_metadata;")
-        for i in range(numberofpartitions):
-            cur.execute(f"DROP TABLE IF EXISTS range_part{i} CASCADE;")
+        if boundaries == 'equidepth':
+            boundaries = compute_equidepth_boundaries(ratingstablename, numberofpartitions, openconnection,
+                                                      samplepercent)
+        bounds = _range_bounds(numberofpartitions, boundaries)
+        table_names = [f"range_part{i}" for i in range(numberofpartitions)]
+        counts = []
+        span.mark('setup')
+
+        if native:
+            # ratings trở thành bảng PARTITION BY RANGE, planner tự định tuyến và cắt tỉa
+            cur.execute("DELETE FROM range_metadata;")
+            counts = _build_native_partitions(
+                cur, ratingstablename, 'RANGE (rating)', table_names,
+                _native_range_clauses(bounds, _rating_is_real(cur, ratingstablename)),
+            )
+            span.mark('fill')
+            _finish_partition_tables(cur, table_names, indexes)
+            span.mark('finish')
+            _write_range_metadata(cur, table_names, bounds)
+            span.mark('metadata')
+        else:
+            _check_not_native(cur, table_names)
+            if workers > 1:
+                # Mỗi worker đổ dữ liệu vào bảng build_range_partN trên kết nối riêng
+                jobs = []
+                for i, (minRange, maxRange) in enumerate(bounds):
+                    lower_op = '>=' if i == 0 else '>'
+                    jobs.append((
+                        table_names[i],
+                        f"SELECT userid, movieid, rating FROM {ratingstablename} "
+                        f"WHERE rating {lower_op} %s AND rating <= %s",
+                        (minRange, maxRange),
+                    ))
+                counts = _parallel_build(openconnection, jobs, workers, unlogged=unlogged, like=ratingstablename)
+                span.mark('parallel_fill')
+
+            cur.execute("DELETE FROM range_metadata;")
+            for i in range(numberofpartitions):
+                cur.execute(f"DROP TABLE IF EXISTS range_part{i} CASCADE;")
+            span.mark('drop')
+
+            for i, (minRange, maxRange) in enumerate(bounds):
+                table_name = table_names[i]
+
+                if workers > 1:
+                    cur.execute(f"ALTER TABLE {_build_table_name(table_name)} RENAME TO {table_name};")
+                else:
+                    _create_partition_table(cur, table_name, unlogged=unlogged, like=ratingstablename)
+
+                    if not singlepass:
+                        if i == 0:
+                            cur.execute(f"""
+                                INSERT INTO {table_name} (userid, movieid, rating)
+                                SELECT userid, movieid, rating FROM {ratingstablename}
+                                WHERE rating >= %s AND rating <= %s;
+                            """, (minRange, maxRange))
+                        else:
+                            cur.execute(f"""
+                                INSERT INTO {table_name} (userid, movieid, rating)
+                                SELECT userid, movieid, rating FROM {ratingstablename}
+                                WHERE rating > %s AND rating <= %s;
+                            """, (minRange, maxRange))
+                        counts.append(cur.rowcount)
+            span.mark('create_fill')
+
+            _write_range_metadata(cur, table_names, bounds)
+            span.mark('metadata')
+
+            if singlepass and workers <= 1:
+                # Đọc bảng ratings đúng một lần, định tuyến từng dòng sang partition tương ứng
+                counts, known = _fanout_copy(
+                    cur,
+                    f"SELECT userid, movieid, rating FROM {ratingstablename}",
+                    table_names,
+                    _range_router(bounds),
+                    stats, stats and _rating_is_real(cur, ratingstablename),
+                )
+                span.mark('fill')
+            _finish_partition_tables(cur, table_names, indexes, bulk)
+            span.mark('finish')
+
+        if stats:
+            _refresh_partition_stats(cur, 'range_part', table_names, known)
+        else:
+            _clear_partition_stats(cur, 'range_part')
+        span.mark('stats')
+        span.commit(openconnection)
+        span.mark('commit')
+        span.finish(sum(counts))
+        return counts
+    except Exception as e:
+        span.fail()
+        if openconnection:
+            openconnection.rollback()
+            if workers > 1:
+                _drop_build_tables(openconnection, table_names)
+        print(f"Error in range partition: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
+
+def _clamped_intervals(ends):
+    # Khoảng (lo, hi] của từng partition theo quy tắc định tuyến của rangeinsert:
+    # partition đầu và cuối nhận luôn mọi giá trị nằm ngoài miền
+    lows = [-math.inf] + list(ends[:-1])
+    highs = list(ends[:-1]) + [math.inf]
+    return list(zip(lows, highs))
+
+def _interval_predicate(lo, hi):
+    conditions = []
+    if lo != -math.inf:
+        conditions.append(f"rating > {lo!r}")
+    if hi != math.inf:
+        conditions.append(f"rating <= {hi!r}")
+    return " AND ".join(conditions) or "TRUE"
 
-        delta = 5.0 / numberofpartitions
+def _pick_donors(old_intervals, new_intervals, domain):
+    # Mỗi partition mới giữ lại (đổi tên) bảng cũ chồng lấn nhiều nhất với nó, mỗi bảng cũ dùng tối đa một lần
+    def overlap(a, b):
+        lo = max(a[0], b[0], domain[0])
+        hi = min(a[1], b[1], domain[1])
+        return hi - lo
+    candidates = sorted(
+        ((overlap(o, n), i, j) for i, o in enumerate(old_intervals) for j, n in enumerate(new_intervals)),
+        reverse=True,
+    )
+    donors = {}
+    used = set()
+    for length, i, j in candidates:
+        if length > 0 and i not in used and j not in donors:
+            donors[j] = i
+            used.add(i)
+    return donors
 
-        for i in range(numberofpartitions):
-            minRange = round(i * delta, 6)
-            maxRange = round(minRange + delta, 6)
-            table_name = f"range_part{i}"
+def _rename_table_indexes(cur, table_name, old_prefix, new_prefix):
+    # Index đặt theo tên bảng ({bảng}_{cột}_idx) đi theo bảng khi bảng được đổi tên
+    cur.execute("""
+        SELECT c.relname FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+        WHERE x.indrelid = to_regclass(%s);
+    """, (table_name,))
+    for (index_name,) in cur.fetchall():
+        if index_name.startswith(f"{old_prefix}_"):
+            cur.execute(f"ALTER INDEX {index_name} RENAME TO {new_prefix}{index_name[len(old_prefix):]};")
 
+def repartition(numberofpartitions, openconnection, boundaries=None):
+    """Change the range layout to `numberofpartitions` partitions (or explicit
+    `boundaries`) in place. Each new partition takes over the old table that
+    overlaps it most; only rows whose partition changes are moved. The swap
+    happens in a single transaction. Returns the number of rows moved."""
+    span = Metrics.span('repartition')
+    cur = None
+    try:
+        if numberofpartitions <= 0:
+            raise ValueError("Number of partitions must be greater than 0.")
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        old = _load_partition_layout('range_part', openconnection, span.cursor_factory)
+        if not old.table_names:
+            raise Exception("No range partitions found in metadata")
+        if old.native:
+            raise ValueError("Declarative range partitions are rebuilt with rangepartition(..., native=True).")
+
+        bounds = _range_bounds(numberofpartitions, boundaries)
+        new_names = [f"range_part{i}" for i in range(numberofpartitions)]
+        old_intervals = _clamped_intervals(old.ends)
+        new_intervals = _clamped_intervals([b[1] for b in bounds])
+        domain = (min(old.starts[0], bounds[0][0]), max(old.ends[-1], bounds[-1][1]))
+        donors = _pick_donors(old_intervals, new_intervals, domain)
+        previous = _fetch_partition_stats(cur, 'range_part') if old.stats else {}
+        changed = set()
+
+        cur.execute("SELECT relpersistence FROM pg_class WHERE oid = to_regclass(%s);", (old.table_names[0],))
+        kind = "UNLOGGED TABLE" if cur.fetchone()[0] == 'u' else "TABLE"
+
+        # Đổi tên toàn bộ bảng cũ (và index của chúng) để giải phóng tên range_partN
+        old_names = [f"range_repart_old{i}" for i in range(len(old.table_names))]
+        for table_name, old_name in zip(old.table_names, old_names):
+            cur.execute(f"ALTER TABLE {table_name} RENAME TO {old_name};")
+            _rename_table_indexes(cur, old_name, table_name, old_name)
+        cur.execute("DROP TABLE IF EXISTS range_repart_spill;")
+        cur.execute(f"CREATE TEMP TABLE range_repart_spill (LIKE {old_names[0]});")
+
+        moved = 0
+        template = old_names[0]
+        for j, i in donors.items():
+            cur.execute(f"ALTER TABLE {old_names[i]} RENAME TO {new_names[j]};")
+            _rename_table_indexes(cur, new_names[j], old_names[i], new_names[j])
+            if i == 0:
+                template = new_names[j]
+            (old_lo, old_hi), (new_lo, new_hi) = old_intervals[i], new_intervals[j]
+            if new_lo <= old_lo and old_hi <= new_hi:
+                continue
+            changed.add(j)
             cur.execute(f"""
-                CREATE TABLE {table_name} (
-                    userid INTEGER,
-                    movieid INTEGER,
-                    rating FLOAT
-                );
+                WITH moved AS (
+                    DELETE FROM {new_names[j]} WHERE NOT ({_interval_predicate(new_lo, new_hi)})
+                    RETURNING userid, movieid, rating
+                )
+                INSERT INTO range_repart_spill (userid, movieid, rating) SELECT * FROM moved;
             """)
+            moved += cur.rowcount
+        # Bảng mới cùng kiểu lưu trữ và cùng bộ index với bố cục cũ; LIKE đặt tên index theo {bảng}_{cột}_idx
+        for j, table_name in enumerate(new_names):
+            if j not in donors:
+                cur.execute(f"CREATE {kind} {table_name} (LIKE {template} INCLUDING INDEXES);")
 
-            if i == 0:
-                cur.execute(f"""
-                    INSERT INTO {table_name} (userid, movieid, rating)
-                    SELECT userid, movieid, rating FROM {ratingstablename}
-                    WHERE rating >= %s AND rating <= %s;
-                """, (minRange, maxRange))
-            else:
+        # Chuyển các dòng từ bảng cũ không được giữ lại và từ bảng tràn sang partition mới
+        sources = [(old_names[i], old_intervals[i]) for i in range(len(old_names)) if i not in donors.values()]
+        sources.append(('range_repart_spill', (-math.inf, math.inf)))
+        for source, (src_lo, src_hi) in sources:
+            for j, (new_lo, new_hi) in enumerate(new_intervals):
+                if max(src_lo, new_lo) >= min(src_hi, new_hi):
+                    continue
                 cur.execute(f"""
-                    INSERT INTO {table_name} (userid, movieid, rating)
-                    SELECT userid, movieid, rating FROM {ratingstablename}
-                    WHERE rating > %s AND rating <= %s;
-                """, (minRange, maxRange))
+                    INSERT INTO {new_names[j]} (userid, movieid, rating)
+                    SELECT userid, movieid, rating FROM {source}
+                    WHERE {_interval_predicate(new_lo, new_hi)};
+                """)
+                if cur.rowcount:
+                    changed.add(j)
+                if source != 'range_repart_spill':
+                    moved += cur.rowcount
+            cur.execute(f"DROP TABLE {source};")
 
-            cur.execute("""
-                INSERT INTO range_metadata (partition_table_name, range_start, range_end)
-                VALUES (%s, %s, %s);
-            """, (table_name, minRange, maxRange))
+        cur.execute("DELETE FROM range_metadata;")
+        _write_range_metadata(cur, new_names, bounds)
+        # Chỉ quét lại các partition có dòng thay đổi; bảng giữ nguyên mang theo thống kê cũ
+        if old.stats:
+            known = {new_names[j]: previous[old.table_names[i]] for j, i in donors.items()
+                     if j not in changed and old.table_names[i] in previous}
+            _refresh_partition_stats(cur, 'range_part', new_names, known)
+        else:
+            _clear_partition_stats(cur, 'range_part')
 
-        openconnection.commit()
-        print(f"[TIME] Range partition completed in {time.time() - start:.2f} seconds.")
+        span.commit(openconnection)
+        span.finish(moved)
+        return moved
     except Exception as e:
+        span.fail()
         if openconnection:
             openconnection.rollback()
-        print(f"Error in range partition: {e}")
+        print(f"Error in repartition: {e}")
         raise
     finally:
         if cur:
             cur.close()
 
+def _range_index(rating, ends):
+    # Partition đầu tiên có range_end >= rating; giá trị ngoài miền được kẹp vào partition đầu/cuối
+    index = bisect_left(ends, rating)
+    if index >= len(ends):
+        index = len(ends) - 1
+    return index
+
+def _copy_rows(cur, table_name, rows):
+    buf = io.StringIO()
+    for userid, itemid, rating in rows:
+        buf.write(f"{userid}\t{itemid}\t{rating}\n")
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table_name} (userid, movieid, rating) FROM STDIN", buf)
 
 def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
-    start = time.time()
+    span = Metrics.span('rangeinsert')
     cur = None
     try:
-        cur = openconnection.cursor()
-        numberofpartitions = count_partitions('range_part', openconnection)
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        layout = get_partition_layout('range_part', openconnection, span.cursor_factory)
+        numberofpartitions = len(layout.table_names)
         if numberofpartitions == 0:
             raise Exception("No range partitions found in metadata")
-        delta = 5.0 / numberofpartitions
-        index = int(rating / delta)
-        if rating % delta == 0 and index != 0:
-            index -= 1
-        if index >= numberofpartitions:
-            index = numberofpartitions - 1
-        table_name = f"range_part{index}"
+        span.mark('layout')
         cur.execute(
             f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES (%s, %s, %s);",
             (userid, itemid, rating)
         )
-        cur.execute(
-            f"INSERT INTO {table_name} (userid, movieid, rating) VALUES (%s, %s, %s);",
-            (userid, itemid, rating)
-        )
-        openconnection.commit()
-        print(f"[TIME]Range insert done in {time.time() - start:.4f} seconds.")
+        span.mark('ratings_insert')
+        table_name = layout.table_names[_range_index(rating, layout.ends)]
+        if not layout.native:
+            cur.execute(
+                f"INSERT INTO {table_name} (userid, movieid, rating) VALUES (%s, %s, %s);",
+                (userid, itemid, rating)
+            )
+            span.mark('partition_insert')
+        if layout.stats:
+            _add_partition_stats(cur, [_rating_stats(table_name, [rating])])
+            span.mark('stats')
+        span.commit(openconnection)
+        span.mark('commit')
+        span.finish(1)
     except Exception as e:
+        span.fail()
         if openconnection:
             openconnection.rollback()
+            _reset_layout_cache(openconnection)
         print(f"Error in rangeinsert: {e}")
         raise
     finally:
         if cur:
             cur.close()
 
+def rangeinsert_many(ratingstablename, rows, openconnection):
+    """Insert an iterable of (userid, movieid, rating) tuples in one
+    transaction: rows are routed in memory and each partition receives a
+    single COPY. Returns the number of rows written to each partition."""
+    span = Metrics.span('rangeinsert_many')
+    cur = None
+    try:
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        rows = list(rows)
+        layout = get_partition_layout('range_part', openconnection, span.cursor_factory)
+        numberofpartitions = len(layout.table_names)
+        if numberofpartitions == 0:
+            raise Exception("No range partitions found in metadata")
+        groups = [[] for _ in range(numberofpartitions)]
+        for row in rows:
+            groups[_range_index(row[2], layout.ends)].append(row)
+        _copy_rows(cur, ratingstablename, rows)
+        if not layout.native:
+            for table_name, group in zip(layout.table_names, groups):
+                if group:
+                    _copy_rows(cur, table_name, group)
+        if layout.stats:
+            _add_partition_stats(cur, [_rating_stats(table_name, [row[2] for row in group])
+                                       for table_name, group in zip(layout.table_names, groups) if group])
+        span.commit(openconnection)
+        span.finish(len(rows))
+        return [len(group) for group in groups]
+    except Exception as e:
+        span.fail()
+        if openconnection:
+            openconnection.rollback()
+            _reset_layout_cache(openconnection)
+        print(f"Error in rangeinsert_many: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
 def create_roundrobin_partition_metadata_table(openconnection):
     cur = None
     try:
@@ -218,57 +1001,151 @@ def create_roundrobin_partition_metadata_table(openconnection):
         if cur:
             cur.close()
 
-def roundrobinpartition(ratingstablename, numberofpartitions, openconnection):
-    import time
-    start = time.time()
+def _roundrobin_router(numberofpartitions):
+    state = {'next': 0}
+
+    def route(line):
+        index = state['next']
+        state['next'] = (index + 1) % numberofpartitions
+        return index
+
+    return route
+
+def _write_roundrobin_metadata(cur, table_names, total_rows):
+    for table_name in table_names:
+        cur.execute("INSERT INTO roundrobin_metadata (partition_table_name) VALUES (%s);", (table_name,))
+
+    # Tính last_rr_index
+    last_index = (total_rows - 1) % len(table_names) if total_rows > 0 else -1
+
+    # Cập nhật tracker
+    cur.execute("""
+        INSERT INTO rr_index_tracker (id, last_rr_index)
+        VALUES (1, %s)
+        ON CONFLICT (id) DO UPDATE SET last_rr_index = EXCLUDED.last_rr_index;
+    """, (last_index,))
+    _notify_layout_change(cur, 'rrobin_part')
+
+def roundrobinpartition(ratingstablename, numberofpartitions, openconnection, singlepass=False, workers=1,
+                        native=False, bulk=False, indexes=None, durable=True, stats=False):
+    span = Metrics.span('roundrobinpartition')
     cur = None
+    table_names = []
+    known = {}
+    unlogged = bulk and not durable
     try:
-        cur = openconnection.cursor()
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
 
         create_roundrobin_partition_metadata_table(openconnection)
-        cur.execute("DELETE FROM roundrobin_metadata;")
+        table_names = [f"rrobin_part{i}" for i in range(numberofpartitions)]
+        span.mark('setup')
+
+        if native:
+            # ratings trở thành bảng PARTITION BY HASH: phân bố đều nhưng không theo thứ tự vòng tròn
+            cur.execute("DELETE FROM roundrobin_metadata;")
+            counts = _build_native_partitions(
+                cur, ratingstablename, 'HASH (userid, movieid)', table_names,
+                [f"FOR VALUES WITH (MODULUS {numberofpartitions}, REMAINDER {i})" for i in range(numberofpartitions)],
+            )
+            span.mark('fill')
+            _finish_partition_tables(cur, table_names, indexes)
+            span.mark('finish')
+            total_rows = sum(counts)
+        else:
+            _check_not_native(cur, table_names)
+            if workers > 1:
+                # Đánh số theo (userid, movieid) một lần vào bảng UNLOGGED đã commit để các worker cùng đọc;
+                # mỗi worker chỉ lọc phần của mình thay vì tự sắp xếp lại toàn bộ ratings
+                numbered = _build_table_name(RR_NUMBERED_TABLE)
+                cur.execute(f"DROP TABLE IF EXISTS {numbered};")
+                cur.execute(f"""
+                    CREATE UNLOGGED TABLE {numbered} AS
+                    SELECT userid, movieid, rating,
+                           ROW_NUMBER() OVER (ORDER BY userid, movieid) AS rnum
+                    FROM {ratingstablename};
+                """)
+                span.commit(openconnection)
+                span.mark('number')
+                jobs = []
+                for i, table_name in enumerate(table_names):
+                    jobs.append((
+                        table_name,
+                        f"SELECT userid, movieid, rating FROM {numbered} WHERE MOD(rnum - 1, %s) = %s",
+                        (numberofpartitions, i),
+                    ))
+                counts = _parallel_build(openconnection, jobs, workers, unlogged=unlogged, like=ratingstablename)
+                cur.execute(f"DROP TABLE {numbered};")
+                span.mark('parallel_fill')
 
-        # Drop và tạo lại các partition
-        for i in range(numberofpartitions):
-            cur.execute(f"DROP TABLE IF EXISTS rrobin_part{i} CASCADE;")
-            cur.execute(f"CREATE TABLE rrobin_part{i} (userid INTEGER, movieid INTEGER, rating FLOAT);")
+            cur.execute("DELETE FROM roundrobin_metadata;")
 
-        # Tạo bảng tạm chứa dữ liệu đã đánh số thứ tự
-        cur.execute("DROP TABLE IF EXISTS temp_rr_table;")
-        cur.execute(f"""
-            CREATE TEMP TABLE temp_rr_table AS
-            SELECT userid, movieid, rating,
-                   ROW_NUMBER() OVER (ORDER BY userid, movieid) AS rnum
-            FROM {ratingstablename};
-        """)
+            # Drop và tạo lại các partition
+            for table_name in table_names:
+                cur.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE;")
+                if workers > 1:
+                    cur.execute(f"ALTER TABLE {_build_table_name(table_name)} RENAME TO {table_name};")
+                else:
+                    _create_partition_table(cur, table_name, unlogged=unlogged, like=ratingstablename)
+            span.mark('drop_create')
 
-        # Chèn dữ liệu vào từng partition
-        for i in range(numberofpartitions):
-            cur.execute(f"""
-                INSERT INTO rrobin_part{i} (userid, movieid, rating)
-                SELECT userid, movieid, rating
-                FROM temp_rr_table
-                WHERE MOD(rnum - 1, %s) = %s;
-            """, (numberofpartitions, i))
-            cur.execute("INSERT INTO roundrobin_metadata (partition_table_name) VALUES (%s);", (f"rrobin_part{i}",))
-
-        # Tính last_rr_index
-        cur.execute("SELECT COUNT(*) FROM temp_rr_table;")
-        total_rows = cur.fetchone()[0]
-        last_index = (total_rows - 1) % numberofpartitions if total_rows > 0 else -1
-
-        # Cập nhật tracker
-        cur.execute("""
-            INSERT INTO rr_index_tracker (id, last_rr_index)
-            VALUES (1, %s)
-            ON CONFLICT (id) DO UPDATE SET last_rr_index = EXCLUDED.last_rr_index;
-        """, (last_index,))
+            if workers > 1:
+                total_rows = sum(counts)
+            elif singlepass:
+                # Đọc ratings một lần theo đúng thứ tự (userid, movieid), gán partition khi dòng đi qua
+                counts, known = _fanout_copy(
+                    cur,
+                    f"SELECT userid, movieid, rating FROM {ratingstablename} ORDER BY userid, movieid",
+                    table_names,
+                    _roundrobin_router(numberofpartitions),
+                    stats, stats and _rating_is_real(cur, ratingstablename),
+                )
+                total_rows = sum(counts)
+            else:
+                # Tạo bảng tạm chứa dữ liệu đã đánh số thứ tự
+                cur.execute("DROP TABLE IF EXISTS temp_rr_table;")
+                cur.execute(f"""
+                    CREATE TEMP TABLE temp_rr_table AS
+                    SELECT userid, movieid, rating,
+                           ROW_NUMBER() OVER (ORDER BY userid, movieid) AS rnum
+                    FROM {ratingstablename};
+                """)
 
-        openconnection.commit()
-        print(f"[TIME] Round robin partition completed in {time.time() - start:.2f} seconds.")
+                # Chèn dữ liệu vào từng partition
+                counts = []
+                for i in range(numberofpartitions):
+                    cur.execute(f"""
+                        INSERT INTO rrobin_part{i} (userid, movieid, rating)
+                        SELECT userid, movieid, rating
+                        FROM temp_rr_table
+                        WHERE MOD(rnum - 1, %s) = %s;
+                    """, (numberofpartitions, i))
+                    counts.append(cur.rowcount)
+
+                cur.execute("SELECT COUNT(*) FROM temp_rr_table;")
+                total_rows = cur.fetchone()[0]
+            span.mark('fill')
+            _finish_partition_tables(cur, table_names, indexes, bulk)
+            span.mark('finish')
+
+        _write_roundrobin_metadata(cur, table_names, total_rows)
+        span.mark('metadata')
+        # Partition khai báo HASH: không biết trước dòng mới rơi vào partition nào nên không duy trì thống kê
+        if stats and not native:
+            _refresh_partition_stats(cur, 'rrobin_part', table_names, known)
+        else:
+            _clear_partition_stats(cur, 'rrobin_part')
+        span.mark('stats')
+
+        span.commit(openconnection)
+        span.mark('commit')
+        span.finish(sum(counts))
+        return counts
     except Exception as e:
+        span.fail()
         if openconnection:
             openconnection.rollback()
+            if workers > 1:
+                _drop_build_tables(openconnection, table_names + [RR_NUMBERED_TABLE])
         print(f"Error in roundrobin partition: {e}")
         raise
     finally:
@@ -276,33 +1153,1065 @@ def roundrobinpartition(ratingstablename, numberofpartitions, openconnection):
             cur.close()
 
 
-def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
-    start = time.time()
+def _reserve_rr_block(cur, count, numberofpartitions):
+    # Cấp phát nguyên tử `count` slot liên tiếp, trả về last_rr_index đứng ngay trước slot đầu tiên
+    cur.execute("""
+        UPDATE rr_index_tracker SET last_rr_index = MOD(last_rr_index + %s, %s)
+        WHERE id = 1 RETURNING last_rr_index;
+    """, (count, numberofpartitions))
+    row = cur.fetchone()
+    if row is None:
+        raise Exception("rr_index_tracker is not initialised")
+    return (row[0] - count) % numberofpartitions
+
+def _reserve_rr_slots(cur, count, numberofpartitions):
+    # Chỉ số partition của từng slot vừa cấp phát
+    previous = _reserve_rr_block(cur, count, numberofpartitions)
+    return [(previous + 1 + offset) % numberofpartitions for offset in range(count)]
+
+class RoundRobinSlotAllocator:
+    """Hands out round-robin partition indexes from blocks of `blocksize`
+    consecutive slots reserved on a private autocommit connection.
+
+    Each writer thread/process uses its own allocator, so rr_index_tracker is
+    locked once per block instead of for the whole insert transaction. A
+    block is discarded when the partition count changes; unused slots of a
+    discarded or closed block are skipped.
+    """
+
+    def __init__(self, openconnection, blocksize=64):
+        self.blocksize = blocksize
+        self._con = _open_worker_connection(openconnection)
+        self._con.autocommit = True
+        self._block = []
+        self._numberofpartitions = None
+
+    def next_index(self, numberofpartitions):
+        if numberofpartitions != self._numberofpartitions:
+            self._block = []
+            self._numberofpartitions = numberofpartitions
+        if not self._block:
+            cur = self._con.cursor()
+            try:
+                self._block = _reserve_rr_slots(cur, self.blocksize, numberofpartitions)
+            finally:
+                cur.close()
+            self._block.reverse()
+        return self._block.pop()
+
+    def close(self):
+        self._con.close()
+
+def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection, allocator=None):
+    span = Metrics.span('roundrobininsert')
     cur = None
     try:
-        cur = openconnection.cursor()
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
         cur.execute(f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES (%s, %s, %s)", (userid, itemid, rating))
-        numberofpartitions = count_partitions('rrobin_part', openconnection)
+        span.mark('ratings_insert')
+        layout = get_partition_layout('rrobin_part', openconnection, span.cursor_factory)
+        numberofpartitions = len(layout.table_names)
         if numberofpartitions == 0:
             raise Exception("No roundrobin partitions found in metadata")
-        cur.execute("SELECT last_rr_index FROM rr_index_tracker WHERE id = 1")
-        row = cur.fetchone()
-        last_rr_index = row[0] if row else -1
-        index = (last_rr_index + 1) % numberofpartitions
-        table_name = f"rrobin_part{index}"
-        cur.execute(f"INSERT INTO {table_name} (userid, movieid, rating) VALUES (%s, %s, %s)", (userid, itemid, rating))
-        cur.execute("UPDATE rr_index_tracker SET last_rr_index = %s WHERE id = 1", (index,))
-        openconnection.commit()
-        print(f"[TIME]Round robin insert done in {time.time() - start:.4f} seconds.")
+        span.mark('layout')
+        if not layout.native:
+            if allocator is not None:
+                index = allocator.next_index(numberofpartitions)
+            else:
+                index = _reserve_rr_slots(cur, 1, numberofpartitions)[0]
+            span.mark('slot')
+            table_name = layout.table_names[index]
+            cur.execute(f"INSERT INTO {table_name} (userid, movieid, rating) VALUES (%s, %s, %s)", (userid, itemid, rating))
+            span.mark('partition_insert')
+            if layout.stats:
+                _add_partition_stats(cur, [_rating_stats(table_name, [rating])])
+        span.commit(openconnection)
+        span.mark('commit')
+        span.finish(1)
     except Exception as e:
+        span.fail()
         if openconnection:
             openconnection.rollback()
+            _reset_layout_cache(openconnection)
         print(f"Error in roundrobininsert: {e}")
         raise
     finally:
         if cur:
             cur.close()
 
+def roundrobininsert_many(ratingstablename, rows, openconnection):
+    """Batched roundrobininsert: one COPY per partition and a single
+    rr_index_tracker update for the whole batch, all in one transaction."""
+    span = Metrics.span('roundrobininsert_many')
+    cur = None
+    try:
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        rows = list(rows)
+        layout = get_partition_layout('rrobin_part', openconnection, span.cursor_factory)
+        numberofpartitions = len(layout.table_names)
+        if numberofpartitions == 0:
+            raise Exception("No roundrobin partitions found in metadata")
+        groups = [[] for _ in range(numberofpartitions)]
+        if rows and not layout.native:
+            for index, row in zip(_reserve_rr_slots(cur, len(rows), numberofpartitions), rows):
+                groups[index].append(row)
+        _copy_rows(cur, ratingstablename, rows)
+        for table_name, group in zip(layout.table_names, groups):
+            if group:
+                _copy_rows(cur, table_name, group)
+        if layout.stats:
+            _add_partition_stats(cur, [_rating_stats(table_name, [row[2] for row in group])
+                                       for table_name, group in zip(layout.table_names, groups) if group])
+        span.commit(openconnection)
+        span.finish(len(rows))
+        return [len(group) for group in groups]
+    except Exception as e:
+        span.fail()
+        if openconnection:
+            openconnection.rollback()
+            _reset_layout_cache(openconnection)
+        print(f"Error in roundrobininsert_many: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
+def _numpy():
+    # numpy chỉ cần cho đường định tuyến theo lô
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError("The vectorized routing functions require numpy") from e
+    return numpy
+
+def route_range_batch(ratings, ends):
+    """Partition index of every rating, same rule as _range_index:
+    first partition whose range_end >= rating, clamped to the last one."""
+    np = _numpy()
+    ends = np.asarray(ends, dtype=np.float64)
+    index = np.searchsorted(ends, np.asarray(ratings, dtype=np.float64), side='left')
+    return np.minimum(index, len(ends) - 1)
+
+def route_roundrobin_batch(count, numberofpartitions, last_rr_index):
+    """Partition index of `count` consecutive round robin slots after last_rr_index."""
+    np = _numpy()
+    return (np.arange(count, dtype=np.int64) + (last_rr_index + 1)) % numberofpartitions
+
+def _binary_copy_buffer(userids, movieids, ratings, real=False):
+    # Dựng toàn bộ dữ liệu COPY ... (FORMAT binary) trong một mảng có cấu trúc, không lặp Python theo dòng
+    np = _numpy()
+    rating_dtype, rating_size = ('>f4', 4) if real else ('>f8', 8)
+    rows = np.empty(len(userids), dtype=[
+        ('fields', '>i2'),
+        ('userid_len', '>i4'), ('userid', '>i4'),
+        ('movieid_len', '>i4'), ('movieid', '>i4'),
+        ('rating_len', '>i4'), ('rating', rating_dtype),
+    ])
+    rows['fields'] = 3
+    rows['userid_len'] = 4
+    rows['userid'] = userids
+    rows['movieid_len'] = 4
+    rows['movieid'] = movieids
+    rows['rating_len'] = rating_size
+    rows['rating'] = ratings
+    return b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8 + rows.tobytes() + b'\xff\xff'
+
+def group_copy_buffers(partitionids, numberofpartitions, userids, movieids, ratings, real=False):
+    """Group the rows by partition id and return, per partition, its row
+    count and a binary COPY buffer ready for _copy_binary. `real` is one
+    flag for all partitions or a sequence with one flag per partition."""
+    np = _numpy()
+    partitionids = np.asarray(partitionids)
+    order = np.argsort(partitionids, kind='stable')
+    counts = np.bincount(partitionids, minlength=numberofpartitions)
+    userids = np.asarray(userids)[order]
+    movieids = np.asarray(movieids)[order]
+    ratings = np.asarray(ratings)[order]
+    if not isinstance(real, (list, tuple)):
+        real = [real] * numberofpartitions
+    groups = []
+    offset = 0
+    for count, partition_real in zip(counts.tolist(), real):
+        end = offset + count
+        groups.append((count, _binary_copy_buffer(userids[offset:end], movieids[offset:end], ratings[offset:end],
+                                                  partition_real)))
+        offset = end
+    return groups
+
+def _batch_stats(table_names, partitionids, ratings):
+    # Tổng, tổng bình phương, min, max theo từng partition bằng bincount / ufunc.at
+    np = _numpy()
+    n = len(table_names)
+    ratings = np.asarray(ratings, dtype=np.float64)
+    counts = np.bincount(partitionids, minlength=n)
+    sums = np.bincount(partitionids, weights=ratings, minlength=n)
+    sumsqs = np.bincount(partitionids, weights=ratings * ratings, minlength=n)
+    mins = np.full(n, np.inf)
+    maxs = np.full(n, -np.inf)
+    np.minimum.at(mins, partitionids, ratings)
+    np.maximum.at(maxs, partitionids, ratings)
+    return [(table_names[i], int(counts[i]), float(sums[i]), float(sumsqs[i]), float(mins[i]), float(maxs[i]))
+            for i in range(n) if counts[i]]
+
+def _copy_binary(cur, table_name, buf):
+    cur.copy_expert(f"COPY {table_name} (userid, movieid, rating) FROM STDIN WITH (FORMAT binary)", io.BytesIO(buf))
+
+def _insert_arrays(ratingstablename, userids, movieids, ratings, openconnection, prefix, route, span):
+    cur = None
+    try:
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        layout = get_partition_layout(prefix, openconnection, span.cursor_factory)
+        numberofpartitions = len(layout.table_names)
+        if numberofpartitions == 0:
+            raise Exception(f"No {prefix} partitions found in metadata")
+        # compacttable() chỉ đổi kiểu của một bảng, nên mỗi bảng đích được mã hóa theo kiểu rating của chính nó
+        real = _real_rating_tables(cur, [ratingstablename] + ([] if layout.native else list(layout.table_names)))
+        _copy_binary(cur, ratingstablename, _binary_copy_buffer(userids, movieids, ratings, ratingstablename in real))
+        span.mark('ratings_copy')
+        counts = [0] * numberofpartitions
+        # Partition khai báo: server tự định tuyến khi COPY vào ratings, chỉ cần partition id để cập nhật thống kê
+        if len(ratings) and (not layout.native or layout.stats):
+            partitionids = route(cur, layout)
+            span.mark('route')
+            if not layout.native:
+                groups = group_copy_buffers(partitionids, numberofpartitions, userids, movieids, ratings,
+                                            [t in real for t in layout.table_names])
+                for i, (table_name, (count, buf)) in enumerate(zip(layout.table_names, groups)):
+                    if count:
+                        _copy_binary(cur, table_name, buf)
+                        counts[i] = count
+                span.mark('partition_copy')
+            if layout.stats:
+                _add_partition_stats(cur, _batch_stats(layout.table_names, partitionids, ratings))
+        span.commit(openconnection)
+        span.finish(len(ratings))
+        return counts
+    except Exception as e:
+        span.fail()
+        if openconnection:
+            openconnection.rollback()
+            _reset_layout_cache(openconnection)
+        print(f"Error inserting {prefix} batch: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
+def rangeinsert_arrays(ratingstablename, userids, movieids, ratings, openconnection):
+    """rangeinsert_many for NumPy column arrays: routed with searchsorted and
+    written with one binary COPY per partition. Returns rows per partition."""
+    return _insert_arrays(
+        ratingstablename, userids, movieids, ratings, openconnection, 'range_part',
+        lambda cur, layout: route_range_batch(ratings, layout.ends),
+        Metrics.span('rangeinsert_arrays'),
+    )
+
+def roundrobininsert_arrays(ratingstablename, userids, movieids, ratings, openconnection):
+    """roundrobininsert_many for NumPy column arrays: one rr_index_tracker
+    update for the whole batch, then one binary COPY per partition."""
+    def route(cur, layout):
+        numberofpartitions = len(layout.table_names)
+        previous = _reserve_rr_block(cur, len(ratings), numberofpartitions)
+        return route_roundrobin_batch(len(ratings), numberofpartitions, previous)
+
+    return _insert_arrays(
+        ratingstablename, userids, movieids, ratings, openconnection, 'rrobin_part',
+        route, Metrics.span('roundrobininsert_arrays'),
+    )
+
+class PartitionWriter:
+    """Routing writer that inserts through server-side prepared statements.
+
+    One statement is PREPAREd per target table (ratings and each
+    range_partN/rrobin_partN) the first time it is used, plus one for the
+    rr_index_tracker update, and later inserts only EXECUTE them. When the
+    partition layout changes the partition statements are DEALLOCATEd and
+    prepared again on demand.
+    """
+
+    def __init__(self, ratingstablename, openconnection, allocator=None):
+        self.ratingstablename = ratingstablename
+        self.openconnection = openconnection
+        self.allocator = allocator
+        self._id = next(_cursor_ids)
+        # bảng -> tên prepared statement
+        self._statements = {}
+        # prefix -> PartitionLayout đã dùng để chuẩn bị statement
+        self._layouts = {}
+
+    def _prepare(self, cur, key, sql):
+        name = self._statements.get(key)
+        if name is None:
+            name = f"pw{self._id}_{next(_cursor_ids)}"
+            cur.execute(f"PREPARE {name} AS {sql};")
+            self._statements[key] = name
+        return name
+
+    def _insert(self, cur, table_name, userid, itemid, rating):
+        name = self._prepare(cur, table_name,
+                             f"INSERT INTO {table_name} (userid, movieid, rating) VALUES ($1, $2, $3)")
+        cur.execute(f"EXECUTE {name} (%s, %s, %s);", (userid, itemid, rating))
+
+    def _add_stats(self, cur, layout, table_name, rating):
+        if not layout.stats:
+            return
+        name = self._prepare(cur, 'partition_stats', """
+            INSERT INTO partition_stats
+                (partition_table_name, row_count, rating_sum, rating_sumsq, rating_min, rating_max)
+            VALUES ($1::VARCHAR, 1, $2::FLOAT, $2::FLOAT * $2::FLOAT, $2::FLOAT, $2::FLOAT)""" + _STATS_UPSERT)
+        cur.execute(f"EXECUTE {name} (%s, %s);", (table_name, rating))
+
+    def _layout(self, cur, prefix):
+        layout = get_partition_layout(prefix, self.openconnection, type(cur))
+        previous = self._layouts.get(prefix)
+        if previous is not None and previous is not layout:
+            # Bố cục đã được nạp lại: bỏ statement của các partition cũ
+            stale = [t for t in previous.table_names if t in self._statements]
+            for table_name in stale:
+                cur.execute(f"DEALLOCATE {self._statements.pop(table_name)};")
+        self._layouts[prefix] = layout
+        return layout
+
+    def _forget(self):
+        # Prepared statement không bị rollback hủy, nhưng có thể chưa kịp tạo: chỉ DEALLOCATE những cái còn tồn tại
+        names = list(self._statements.values())
+        self._statements.clear()
+        self._layouts.clear()
+        _reset_layout_cache(self.openconnection)
+        cur = self.openconnection.cursor()
+        try:
+            cur.execute("SELECT name FROM pg_prepared_statements WHERE name = ANY(%s);", (names,))
+            for (name,) in cur.fetchall():
+                cur.execute(f"DEALLOCATE {name};")
+            self.openconnection.commit()
+        finally:
+            cur.close()
+
+    def rangeinsert(self, userid, itemid, rating):
+        span = Metrics.span('writer_rangeinsert')
+        cur = None
+        try:
+            cur = self.openconnection.cursor(cursor_factory=span.cursor_factory)
+            layout = self._layout(cur, 'range_part')
+            if not layout.table_names:
+                raise Exception("No range partitions found in metadata")
+            self._insert(cur, self.ratingstablename, userid, itemid, rating)
+            table_name = layout.table_names[_range_index(rating, layout.ends)]
+            if not layout.native:
+                self._insert(cur, table_name, userid, itemid, rating)
+            self._add_stats(cur, layout, table_name, rating)
+            span.commit(self.openconnection)
+            span.finish(1)
+        except Exception as e:
+            span.fail()
+            self.openconnection.rollback()
+            self._forget()
+            print(f"Error in PartitionWriter.rangeinsert: {e}")
+            raise
+        finally:
+            if cur:
+                cur.close()
+
+    def roundrobininsert(self, userid, itemid, rating):
+        span = Metrics.span('writer_roundrobininsert')
+        cur = None
+        try:
+            cur = self.openconnection.cursor(cursor_factory=span.cursor_factory)
+            self._insert(cur, self.ratingstablename, userid, itemid, rating)
+            layout = self._layout(cur, 'rrobin_part')
+            numberofpartitions = len(layout.table_names)
+            if numberofpartitions == 0:
+                raise Exception("No roundrobin partitions found in metadata")
+            if not layout.native:
+                if self.allocator is not None:
+                    index = self.allocator.next_index(numberofpartitions)
+                else:
+                    name = self._prepare(cur, 'rr_index_tracker', """
+                        UPDATE rr_index_tracker SET last_rr_index = MOD(last_rr_index + 1, $1)
+                        WHERE id = 1 RETURNING last_rr_index""")
+                    cur.execute(f"EXECUTE {name} (%s);", (numberofpartitions,))
+                    row = cur.fetchone()
+                    if row is None:
+                        raise Exception("rr_index_tracker is not initialised")
+                    index = row[0]
+                self._insert(cur, layout.table_names[index], userid, itemid, rating)
+                self._add_stats(cur, layout, layout.table_names[index], rating)
+            span.commit(self.openconnection)
+            span.finish(1)
+        except Exception as e:
+            span.fail()
+            self.openconnection.rollback()
+            self._forget()
+            print(f"Error in PartitionWriter.roundrobininsert: {e}")
+            raise
+        finally:
+            if cur:
+                cur.close()
+
+    def close(self):
+        """DEALLOCATE every statement of this writer; the connection stays open."""
+        self._forget()
+
+def loadpartitioned(ratingstablename, ratingsfilepath, scheme, numberofpartitions, openconnection,
+                    loadratingstable=True, boundaries=None, compact=False, stats=False):
+    """Read the ratings file once and COPY every row straight into its
+    range_partN / rrobin_partN table (and into `ratingstablename` when
+    `loadratingstable` is set), leaving the same metadata as
+    rangepartition / roundrobinpartition. With `stats`, partition_stats is
+    filled from the same pass.
+
+    Round robin assigns rows in file order; MovieLens files are already
+    sorted by (userid, movieid), which matches roundrobinpartition.
+    """
+    span = Metrics.span('loadpartitioned')
+    cur = None
+    try:
+        if numberofpartitions <= 0:
+            raise ValueError("Number of partitions must be greater than 0.")
+        if scheme == 'range':
+            create_range_partition_metadata_table(openconnection)
+            prefix = 'range_part'
+            bounds = _range_bounds(numberofpartitions, boundaries)
+            route = _range_router(bounds)
+        elif scheme == 'roundrobin':
+            create_roundrobin_partition_metadata_table(openconnection)
+            prefix = 'rrobin_part'
+            route = _roundrobin_router(numberofpartitions)
+        else:
+            raise ValueError(f"Unknown partitioning scheme: {scheme}")
+
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        table_names = [f"{prefix}{i}" for i in range(numberofpartitions)]
+        tables = table_names + [ratingstablename] if loadratingstable else table_names
+        _check_not_native(cur, table_names)
+        for table_name in tables:
+            cur.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE;")
+            _create_partition_table(cur, table_name, compact=compact)
+
+        router = _CopyRouter(numberofpartitions, route, stats, compact)
+        tee = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, mode='w+b') if loadratingstable else None
+        try:
+            with open(ratingsfilepath, 'rb') as f:
+                reader = _RatingsFileReader(f)
+                while True:
+                    chunk = reader.read(COPY_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    router.write(chunk)
+                    if tee:
+                        tee.write(chunk)
+            counts = router.copy_into(cur, table_names)
+            known = router.partition_stats(table_names)
+            if tee:
+                tee.seek(0)
+                cur.copy_expert(f"COPY {ratingstablename} (userid, movieid, rating) FROM STDIN", tee)
+        finally:
+            router.close()
+            if tee:
+                tee.close()
+
+        if scheme == 'range':
+            cur.execute("DELETE FROM range_metadata;")
+            _write_range_metadata(cur, table_names, bounds)
+        else:
+            cur.execute("DELETE FROM roundrobin_metadata;")
+            _write_roundrobin_metadata(cur, table_names, sum(counts))
+        if stats:
+            _refresh_partition_stats(cur, prefix, table_names, known)
+        else:
+            _clear_partition_stats(cur, prefix)
+
+        span.commit(openconnection)
+        span.finish(sum(counts))
+        return counts
+    except Exception as e:
+        span.fail()
+        if openconnection:
+            openconnection.rollback()
+        print(f"Error in partitioned load: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
+def create_hash_partition_metadata_table(openconnection):
+    cur = None
+    try:
+        cur = openconnection.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS hash_metadata (
+                partition_id SERIAL PRIMARY KEY,
+                partition_table_name VARCHAR(50) NOT NULL UNIQUE,
+                key_column VARCHAR(50) NOT NULL
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS hash_ring (
+                token BIGINT PRIMARY KEY,
+                partition_table_name VARCHAR(50) NOT NULL
+            );
+        """)
+        openconnection.commit()
+    except Exception as e:
+        print(f"Error creating hash metadata tables: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
+def _hash_value(value):
+    # Băm nhân Knuth trên 32 bit; _hash_sql tính đúng giá trị này phía server
+    return (int(value) * 2654435761) & 0xFFFFFFFF
+
+def _hash_sql(key):
+    return f"(({key}::BIGINT * 2654435761) & 4294967295)"
+
+def _vnode_tokens(table_name):
+    return [zlib.crc32(f"{table_name}#{v}".encode()) for v in range(HASH_VNODES)]
+
+def _ring_owner(tokens, owners, value):
+    # Token đầu tiên >= giá trị băm, quay vòng về token nhỏ nhất
+    index = bisect_left(tokens, _hash_value(value))
+    return owners[index % len(tokens)]
+
+def _build_ring(table_names):
+    ring = {}
+    for table_name in table_names:
+        for token in _vnode_tokens(table_name):
+            ring.setdefault(token, table_name)
+    tokens = sorted(ring)
+    return tokens, [ring[t] for t in tokens]
+
+def _write_hash_metadata(cur, table_names, key, ring):
+    for table_name in table_names:
+        cur.execute(
+            "INSERT INTO hash_metadata (partition_table_name, key_column) VALUES (%s, %s);",
+            (table_name, key),
+        )
+    for token, owner in zip(*ring):
+        cur.execute(
+            "INSERT INTO hash_ring (token, partition_table_name) VALUES (%s, %s) ON CONFLICT (token) DO NOTHING;",
+            (token, owner),
+        )
+    _notify_layout_change(cur, 'hash_part')
+
+def hashpartition(ratingstablename, numberofpartitions, openconnection, key='userid', stats=False):
+    """Partition on `key` with a consistent-hash ring (HASH_VNODES virtual
+    nodes per partition, stored in hash_ring), so that all ratings of one
+    key live in a single hash_partN table. Rows are routed in one pass;
+    with `stats`, partition_stats is computed in the same pass."""
+    span = Metrics.span('hashpartition')
+    cur = None
+    try:
+        if numberofpartitions <= 0:
+            raise ValueError("Number of partitions must be greater than 0.")
+        if key not in HASH_KEYS:
+            raise ValueError(f"Hash key must be one of {HASH_KEYS}.")
+
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        create_hash_partition_metadata_table(openconnection)
+        cur.execute("SELECT partition_table_name FROM hash_metadata;")
+        old_names = [r[0] for r in cur.fetchall()]
+        cur.execute("DELETE FROM hash_metadata;")
+        cur.execute("DELETE FROM hash_ring;")
+
+        table_names = [f"hash_part{i}" for i in range(numberofpartitions)]
+        for table_name in set(old_names) | set(table_names):
+            cur.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE;")
+        for table_name in table_names:
+            _create_partition_table(cur, table_name, like=ratingstablename)
+
+        tokens, owners = ring = _build_ring(table_names)
+        position = {table_name: i for i, table_name in enumerate(table_names)}
+        field = HASH_KEYS.index(key)
+
+        def route(line):
+            value = line.split('\t', 2)[field]
+            if value == '\\N':
+                return None
+            return position[_ring_owner(tokens, owners, value)]
+
+        counts, known = _fanout_copy(
+            cur, f"SELECT userid, movieid, rating FROM {ratingstablename}", table_names, route,
+            stats, stats and _rating_is_real(cur, ratingstablename),
+        )
+        _write_hash_metadata(cur, table_names, key, ring)
+        if stats:
+            _refresh_partition_stats(cur, 'hash_part', table_names, known)
+        else:
+            _clear_partition_stats(cur, 'hash_part')
+
+        span.commit(openconnection)
+        span.finish(sum(counts))
+        return counts
+    except Exception as e:
+        span.fail()
+        if openconnection:
+            openconnection.rollback()
+        print(f"Error in hash partition: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
+def hashinsert(ratingstablename, userid, itemid, rating, openconnection):
+    span = Metrics.span('hashinsert')
+    cur = None
+    try:
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        layout = get_partition_layout('hash_part', openconnection, span.cursor_factory)
+        if not layout.table_names:
+            raise Exception("No hash partitions found in metadata")
+        value = userid if layout.key == 'userid' else itemid
+        table_name = _ring_owner(layout.ring[0], layout.ring[1], value)
+        cur.execute(
+            f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES (%s, %s, %s);",
+            (userid, itemid, rating)
+        )
+        cur.execute(
+            f"INSERT INTO {table_name} (userid, movieid, rating) VALUES (%s, %s, %s);",
+            (userid, itemid, rating)
+        )
+        if layout.stats:
+            _add_partition_stats(cur, [_rating_stats(table_name, [rating])])
+        span.commit(openconnection)
+        span.finish(1)
+    except Exception as e:
+        span.fail()
+        if openconnection:
+            openconnection.rollback()
+            _reset_layout_cache(openconnection)
+        print(f"Error in hashinsert: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
+def addhashpartition(openconnection):
+    """Add one hash partition. Only the key ranges taken over by the new
+    partition's virtual nodes (about 1/N of the rows) are moved, each with a
+    DELETE ... RETURNING from the previous owner. Returns the rows moved."""
+    span = Metrics.span('addhashpartition')
+    cur = None
+    try:
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        layout = _load_partition_layout('hash_part', openconnection, span.cursor_factory)
+        if not layout.table_names:
+            raise Exception("No hash partitions found in metadata")
+        table_name = f"hash_part{len(layout.table_names)}"
+        cur.execute(f"CREATE TABLE {table_name} (LIKE {layout.table_names[0]});")
+
+        old_tokens, old_owners = layout.ring
+        tokens, owners = _build_ring(layout.table_names + [table_name])
+        ranges = {}
+        for i, (token, owner) in enumerate(zip(tokens, owners)):
+            if owner != table_name:
+                continue
+            previous = tokens[i - 1]
+            source = old_owners[bisect_left(old_tokens, token) % len(old_tokens)]
+            ranges.setdefault(source, []).append((previous, token))
+
+        hashed = _hash_sql(layout.key)
+        moved = 0
+        for source, intervals in ranges.items():
+            conditions = []
+            for lo, hi in intervals:
+                if lo < hi:
+                    conditions.append(f"({hashed} > {lo} AND {hashed} <= {hi})")
+                else:
+                    conditions.append(f"({hashed} > {lo} OR {hashed} <= {hi})")
+            cur.execute(f"""
+                WITH moved AS (
+                    DELETE FROM {source} WHERE {' OR '.join(conditions)}
+                    RETURNING userid, movieid, rating
+                )
+                INSERT INTO {table_name} (userid, movieid, rating) SELECT * FROM moved;
+            """)
+            moved += cur.rowcount
+
+        cur.execute("DELETE FROM hash_ring;")
+        cur.execute("DELETE FROM hash_metadata;")
+        _write_hash_metadata(cur, layout.table_names + [table_name], layout.key, (tokens, owners))
+        if layout.stats:
+            # Chỉ các partition nguồn và partition mới thay đổi
+            previous = _fetch_partition_stats(cur, 'hash_part')
+            known = {t: previous[t] for t in layout.table_names if t not in ranges and t in previous}
+            _refresh_partition_stats(cur, 'hash_part', layout.table_names + [table_name], known)
+
+        span.commit(openconnection)
+        span.finish(moved)
+        return moved
+    except Exception as e:
+        span.fail()
+        if openconnection:
+            openconnection.rollback()
+        print(f"Error adding hash partition: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
+def hashquery(keyvalue, openconnection):
+    """Yield (partition_table_name, userid, movieid, rating) for every rating
+    whose hash key equals `keyvalue`; exactly one partition is scanned."""
+    layout = get_partition_layout('hash_part', openconnection)
+    if not layout.table_names:
+        raise Exception("No hash partitions found in metadata")
+    table_name = _ring_owner(layout.ring[0], layout.ring[1], keyvalue)
+    yield from _stream_partitions([table_name], f"{layout.key} = %s", (keyvalue,), openconnection)
+
+def _load_partition_layout(prefix, openconnection, cursor_factory=None):
+    cur = None
+    try:
+        cur = openconnection.cursor(cursor_factory=cursor_factory)
+        if prefix == 'range_part':
+            cur.execute("""
+                SELECT partition_table_name, range_start, range_end
+                FROM range_metadata ORDER BY partition_id;
+            """)
+        elif prefix == 'rrobin_part':
+            cur.execute("""
+                SELECT partition_table_name, NULL, NULL
+                FROM roundrobin_metadata ORDER BY partition_id;
+            """)
+        elif prefix == 'hash_part':
+            cur.execute("""
+                SELECT partition_table_name, key_column, NULL
+                FROM hash_metadata ORDER BY partition_id;
+            """)
+        else:
+            raise ValueError(f"Unknown partition prefix: {prefix}")
+        rows = cur.fetchall()
+        native = False
+        stats = False
+        if rows:
+            cur.execute("SELECT relispartition FROM pg_class WHERE oid = to_regclass(%s);", (rows[0][0],))
+            row = cur.fetchone()
+            native = bool(row and row[0])
+            stats = _has_partition_stats(cur, rows[0][0])
+        if prefix == 'hash_part':
+            cur.execute("SELECT token, partition_table_name FROM hash_ring ORDER BY token;")
+            ring = cur.fetchall()
+            return PartitionLayout([r[0] for r in rows], None, None, native,
+                                   ([t for t, _ in ring], [o for _, o in ring]),
+                                   rows[0][1] if rows else None, stats)
+        starts = [r[1] for r in rows] if prefix == 'range_part' else None
+        ends = [r[2] for r in rows] if prefix == 'range_part' else None
+        return PartitionLayout([r[0] for r in rows], starts, ends, native, stats=stats)
+    finally:
+        if cur:
+            cur.close()
+
+def _poll_layout_changes(openconnection, cache):
+    # Chỉ đọc những thông báo đã có sẵn trên socket, không tốn round trip
+    openconnection.poll()
+    notifies = openconnection.notifies
+    for notify in notifies:
+        if notify.channel == LAYOUT_CHANNEL:
+            cache.pop(notify.payload, None)
+    notifies[:] = [notify for notify in notifies if notify.channel != LAYOUT_CHANNEL]
+
+def get_partition_layout(prefix, openconnection, cursor_factory=None):
+    """Return the cached PartitionLayout for `prefix` ('range_part' or
+    'rrobin_part') on this connection, loading it from the metadata table on
+    first use or after a rebuild was announced on LAYOUT_CHANNEL.
+    `cursor_factory` (a span's) lets the caller count these queries."""
+    cache = _layout_cache.get(openconnection)
+    if cache is None:
+        cache = _layout_cache[openconnection] = {}
+        cur = openconnection.cursor(cursor_factory=cursor_factory)
+        try:
+            cur.execute(f"LISTEN {LAYOUT_CHANNEL};")
+        finally:
+            cur.close()
+    else:
+        _poll_layout_changes(openconnection, cache)
+    layout = cache.get(prefix)
+    if layout is None:
+        layout = cache[prefix] = _load_partition_layout(prefix, openconnection, cursor_factory)
+    return layout
+
+def _reset_layout_cache(openconnection):
+    # Rollback cũng hủy lệnh LISTEN chưa commit, nên phải nạp và LISTEN lại từ đầu
+    _layout_cache.pop(openconnection, None)
+
+def invalidate_partition_layout(prefix=None):
+    for cache in list(_layout_cache.values()):
+        if prefix is None:
+            cache.clear()
+        else:
+            cache.pop(prefix, None)
+
+def _notify_layout_change(cur, prefix):
+    # NOTIFY chỉ được gửi đi khi transaction commit
+    cur.execute("SELECT pg_notify(%s, %s);", (LAYOUT_CHANNEL, prefix))
+    invalidate_partition_layout(prefix)
+
+def _overlapping_range_partitions(layout, ratingminvalue, ratingmaxvalue):
+    # Cắt tỉa theo khoảng (lo, hi] mà insert thực sự định tuyến vào, không theo [range_start, range_end]:
+    # giá trị ngoài miền nằm ở partition đầu hoặc cuối
+    selected = []
+    for table_name, (lo, hi) in zip(layout.table_names, _clamped_intervals(layout.ends)):
+        if lo < hi and ratingminvalue <= hi and ratingmaxvalue > lo:
+            selected.append(table_name)
+    return selected
+
+def _query_targets(ratingminvalue, ratingmaxvalue, openconnection):
+    cur = openconnection.cursor()
+    try:
+        cur.execute("SELECT to_regclass('range_metadata') IS NOT NULL, to_regclass('roundrobin_metadata') IS NOT NULL;")
+        has_range, has_roundrobin = cur.fetchone()
+    finally:
+        cur.close()
+    targets = []
+    if has_range:
+        layout = get_partition_layout('range_part', openconnection)
+        targets += _overlapping_range_partitions(layout, ratingminvalue, ratingmaxvalue)
+    if has_roundrobin:
+        # Round robin không cắt tỉa được, phải quét mọi partition
+        targets += get_partition_layout('rrobin_part', openconnection).table_names
+    return targets
+
+def _stream_partitions(table_names, condition, params, openconnection):
+    for table_name in table_names:
+        cur = openconnection.cursor(
+            name=f"partition_scan_{next(_cursor_ids)}",
+            withhold=openconnection.autocommit,
+        )
+        cur.itersize = QUERY_ITERSIZE
+        try:
+            cur.execute(f"SELECT userid, movieid, rating FROM {table_name} WHERE {condition};", params)
+            for userid, movieid, rating in cur:
+                yield table_name, userid, movieid, rating
+        finally:
+            cur.close()
+
+def rangequery(ratingminvalue, ratingmaxvalue, openconnection):
+    """Yield (partition_table_name, userid, movieid, rating) for every row with
+    ratingminvalue <= rating <= ratingmaxvalue. Only range partitions whose
+    range overlaps the predicate are scanned; all round robin partitions are.
+    Rows are streamed through server-side cursors."""
+    if ratingminvalue > ratingmaxvalue:
+        return
+    targets = _query_targets(ratingminvalue, ratingmaxvalue, openconnection)
+    yield from _stream_partitions(
+        targets, "rating >= %s AND rating <= %s", (ratingminvalue, ratingmaxvalue), openconnection
+    )
+
+def pointquery(ratingvalue, openconnection):
+    """Same as rangequery for rating = ratingvalue; touches one range partition."""
+    yield from rangequery(ratingvalue, ratingvalue, openconnection)
+
+def _scatter_worker(openconnection, query, params, table_names):
+    con = _open_worker_connection(openconnection)
+    cur = None
+    try:
+        cur = con.cursor()
+        partials = {}
+        for table_name in table_names:
+            cur.execute(query.format(table=table_name), params)
+            partials[table_name] = cur.fetchall()
+        con.commit()
+        return partials
+    finally:
+        if cur:
+            cur.close()
+        con.close()
+
+def scattergather(query, prefix, openconnection, workers=4, params=None, merge=None, key=None):
+    """Run `query` once per partition of `prefix` ('range_part' or 'rrobin_part'),
+    substituting the partition table for `{table}`, over `workers` connections
+    in parallel, then merge the per-partition results:
+
+    - merge=None: concatenate the partial result lists in partition order;
+    - merge='sorted': k-way merge of partials already ORDER BY'ed on `key`;
+    - callable: called with the list of partial result lists.
+    """
+    table_names = get_partition_layout(prefix, openconnection).table_names
+    if not table_names:
+        raise Exception(f"No {prefix} partitions found in metadata")
+    groups = [table_names[i::workers] for i in range(min(workers, len(table_names)))]
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+        for partial in pool.map(lambda group: _scatter_worker(openconnection, query, params, group), groups):
+            results.update(partial)
+    partials = [results[table_name] for table_name in table_names]
+    if merge is None:
+        return [row for partial in partials for row in partial]
+    if merge == 'sorted':
+        return list(heapq.merge(*partials, key=key))
+    return merge(partials)
+
+def _merge_averages(partials):
+    # Gộp (key, sum, count) từ từng partition thành trung bình toàn cục
+    totals = {}
+    for partial in partials:
+        for group_key, total, count in partial:
+            acc = totals.setdefault(group_key, [0.0, 0])
+            acc[0] += total
+            acc[1] += count
+    return {group_key: total / count for group_key, (total, count) in totals.items() if count}
+
+def averageratingpermovie(openconnection, prefix='rrobin_part', workers=4):
+    return scattergather(
+        "SELECT movieid, SUM(rating), COUNT(*) FROM {table} GROUP BY movieid;",
+        prefix, openconnection, workers=workers, merge=_merge_averages,
+    )
+
+# partition_stats chỉ được duy trì khi bố cục được dựng với stats=True. Khi đó mỗi insert còn cập nhật
+# dòng thống kê của partition (thêm một lệnh và giữ khóa dòng đó tới commit), nên các writer ghi
+# cùng partition sẽ phải chờ nhau; bật khi cần aggregate tức thì hơn là thông lượng insert.
+# Cộng dồn một dòng thống kê vào dòng sẵn có của partition
+_STATS_UPSERT = """
+    ON CONFLICT (partition_table_name) DO UPDATE SET
+        row_count = partition_stats.row_count + EXCLUDED.row_count,
+        rating_sum = partition_stats.rating_sum + EXCLUDED.rating_sum,
+        rating_sumsq = partition_stats.rating_sumsq + EXCLUDED.rating_sumsq,
+        rating_min = LEAST(partition_stats.rating_min, EXCLUDED.rating_min),
+        rating_max = GREATEST(partition_stats.rating_max, EXCLUDED.rating_max)
+"""
+
+def _create_partition_stats_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS partition_stats (
+            partition_table_name VARCHAR(50) PRIMARY KEY,
+            row_count BIGINT NOT NULL,
+            rating_sum FLOAT NOT NULL,
+            rating_sumsq FLOAT NOT NULL,
+            rating_min FLOAT,
+            rating_max FLOAT
+        );
+    """)
+
+def _has_partition_stats(cur, table_name):
+    # Chỉ duy trì tiếp khi partition đã có dòng thống kê, tránh cộng dồn lên một bảng chưa từng được tính
+    cur.execute("SELECT to_regclass('partition_stats') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        return False
+    cur.execute("SELECT EXISTS (SELECT 1 FROM partition_stats WHERE partition_table_name = %s);", (table_name,))
+    return cur.fetchone()[0]
+
+def _fetch_partition_stats(cur, prefix):
+    cur.execute("""
+        SELECT partition_table_name, row_count, rating_sum, rating_sumsq, rating_min, rating_max
+        FROM partition_stats WHERE starts_with(partition_table_name, %s);
+    """, (prefix,))
+    return {r[0]: tuple(r[1:]) for r in cur.fetchall()}
+
+def _clear_partition_stats(cur, prefix):
+    # Bố cục dựng lại không kèm thống kê: bỏ các dòng cũ để insert không cộng dồn lên số liệu sai
+    cur.execute("SELECT to_regclass('partition_stats') IS NOT NULL;")
+    if cur.fetchone()[0]:
+        cur.execute("DELETE FROM partition_stats WHERE starts_with(partition_table_name, %s);", (prefix,))
+
+def _refresh_partition_stats(cur, prefix, table_names, known=None):
+    """Replace the partition_stats rows of `prefix` with fresh rows for
+    `table_names`. Tables listed in `known` (name -> stats tuple) keep the
+    given values, all others are scanned once."""
+    _create_partition_stats_table(cur)
+    cur.execute("DELETE FROM partition_stats WHERE starts_with(partition_table_name, %s);", (prefix,))
+    known = known or {}
+    for table_name in table_names:
+        if table_name in known:
+            cur.execute("""
+                INSERT INTO partition_stats
+                    (partition_table_name, row_count, rating_sum, rating_sumsq, rating_min, rating_max)
+                VALUES (%s, %s, %s, %s, %s, %s);
+            """, (table_name,) + tuple(known[table_name]))
+        else:
+            cur.execute(f"""
+                INSERT INTO partition_stats
+                    (partition_table_name, row_count, rating_sum, rating_sumsq, rating_min, rating_max)
+                SELECT %s, COUNT(*), COALESCE(SUM(rating::FLOAT), 0), COALESCE(SUM(rating::FLOAT * rating), 0),
+                       MIN(rating), MAX(rating)
+                FROM {table_name};
+            """, (table_name,))
+
+def _rating_stats(table_name, ratings):
+    ratings = [float(r) for r in ratings]
+    return (table_name, len(ratings), sum(ratings), sum(r * r for r in ratings), min(ratings), max(ratings))
+
+def _add_partition_stats(cur, deltas):
+    # deltas: các bộ (bảng, count, sum, sumsq, min, max), mỗi bảng tối đa một lần; gửi trong một lệnh
+    deltas = [d for d in deltas if d[1]]
+    if not deltas:
+        return
+    columns = list(zip(*deltas))
+    cur.execute("""
+        INSERT INTO partition_stats
+            (partition_table_name, row_count, rating_sum, rating_sumsq, rating_min, rating_max)
+        SELECT * FROM unnest(%s::VARCHAR[], %s::BIGINT[], %s::FLOAT[], %s::FLOAT[], %s::FLOAT[], %s::FLOAT[])
+    """ + _STATS_UPSERT, [list(c) for c in columns])
+
+def _combine_stats(parts):
+    count = sum(p[0] for p in parts)
+    total = sum(p[1] for p in parts)
+    sumsq = sum(p[2] for p in parts)
+    mins = [p[3] for p in parts if p[0]]
+    maxs = [p[4] for p in parts if p[0]]
+    result = {'count': count, 'sum': total, 'avg': None, 'min': min(mins) if mins else None,
+              'max': max(maxs) if maxs else None, 'stddev': None}
+    if count:
+        result['avg'] = total / count
+        result['stddev'] = math.sqrt(max(sumsq / count - result['avg'] ** 2, 0.0))
+    return result
+
+def _scan_stats(cur, table_name, condition='TRUE', params=None):
+    cur.execute(f"""
+        SELECT COUNT(*), COALESCE(SUM(rating::FLOAT), 0), COALESCE(SUM(rating::FLOAT * rating), 0),
+               MIN(rating), MAX(rating)
+        FROM {table_name} WHERE {condition};
+    """, params)
+    return tuple(cur.fetchone())
+
+def partitionstats(prefix, openconnection, table_names=None):
+    """Per-partition synopsis {table: (count, sum, sumsq, min, max)} for
+    `prefix` (or only `table_names`), read from partition_stats. Partitions
+    without a synopsis row are scanned instead."""
+    cur = None
+    try:
+        cur = openconnection.cursor()
+        if table_names is None:
+            table_names = get_partition_layout(prefix, openconnection).table_names
+        cur.execute("SELECT to_regclass('partition_stats') IS NOT NULL;")
+        known = _fetch_partition_stats(cur, prefix) if cur.fetchone()[0] else {}
+        return {t: known[t] if t in known else _scan_stats(cur, t) for t in table_names}
+    except Exception as e:
+        print(f"Error reading partition stats: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+
+def aggregatestats(prefix, openconnection, table_names=None):
+    """COUNT/SUM/AVG/MIN/MAX/STDDEV (population) over all partitions of
+    `prefix`, or over `table_names` only, without reading row data."""
+    return _combine_stats(list(partitionstats(prefix, openconnection, table_names).values()))
+
+def rangeaggregate(ratingminvalue, ratingmaxvalue, openconnection):
+    """Aggregates of the rows with ratingminvalue <= rating <= ratingmaxvalue.
+    Range partitions outside the predicate are pruned, partitions whose
+    min/max lie inside it are answered from partition_stats, and only the
+    partitions cut by a bound are scanned."""
+    if ratingminvalue > ratingmaxvalue:
+        return _combine_stats([])
+    layout = get_partition_layout('range_part', openconnection)
+    selected = _overlapping_range_partitions(layout, ratingminvalue, ratingmaxvalue)
+    stats = partitionstats('range_part', openconnection, selected)
+    cur = openconnection.cursor()
+    try:
+        parts = []
+        for table_name in selected:
+            count, total, sumsq, lo, hi = stats[table_name]
+            if count == 0 or (lo >= ratingminvalue and hi <= ratingmaxvalue):
+                parts.append(stats[table_name])
+            else:
+                parts.append(_scan_stats(cur, table_name, "rating >= %s AND rating <= %s",
+                                         (ratingminvalue, ratingmaxvalue)))
+        return _combine_stats(parts)
+    finally:
+        cur.close()
+
 def count_partitions(prefix, openconnection):
     cur = None
     try:
@@ -321,3 +2230,237 @@ def count_partitions(prefix, openconnection):
     finally:
         if cur:
             cur.close()
+
+def _snapshot_worker(openconnection, snapshot_id, path, table_names):
+    con = _open_worker_connection(openconnection)
+    con.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cur = None
+    try:
+        cur = con.cursor()
+        # Mọi worker đọc cùng một snapshot với kết nối điều phối
+        cur.execute("SET TRANSACTION SNAPSHOT %s;", (snapshot_id,))
+        result = {}
+        for table_name in table_names:
+            with open(os.path.join(path, f"{table_name}.copy"), 'wb', buffering=COPY_CHUNK_BYTES) as f:
+                cur.copy_expert(f"COPY {table_name} TO STDOUT WITH (FORMAT binary)", f, size=COPY_CHUNK_BYTES)
+                result[table_name] = (cur.rowcount, f.tell())
+        con.commit()
+        return result
+    finally:
+        if cur:
+            cur.close()
+        con.close()
+
+def _table_columns(cur, table_name):
+    cur.execute("""
+        SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum;
+    """, (table_name,))
+    return [list(r) for r in cur.fetchall()]
+
+def _balanced_groups(table_names, sizes, workers):
+    # Bảng lớn trước, mỗi bảng vào nhóm đang nhẹ nhất
+    groups = [[] for _ in range(min(workers, len(table_names)))]
+    loads = [0] * len(groups)
+    for table_name in sorted(table_names, key=lambda t: -sizes.get(t, 0)):
+        i = loads.index(min(loads))
+        groups[i].append(table_name)
+        loads[i] += sizes.get(table_name, 0)
+    return [g for g in groups if g]
+
+def snapshot_partitions(path, openconnection, workers=4, ratingstablename=None):
+    """Dump every partition table listed in the metadata tables, the metadata
+    tables themselves and, if `ratingstablename` is given, the ratings table
+    into `path` as one binary COPY file per table, over `workers` connections
+    sharing one exported snapshot. manifest.json is written last and
+    describes columns, indexes and row counts. Returns the manifest."""
+    span = Metrics.span('snapshot_partitions')
+    con = _open_worker_connection(openconnection)
+    con.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cur = None
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT pg_export_snapshot();")
+        snapshot_id = cur.fetchone()[0]
+
+        cur.execute("""
+            SELECT relname FROM pg_class
+            WHERE relname = ANY(%s) AND relkind = 'r' AND relnamespace = 'public'::regnamespace;
+        """, (list(SNAPSHOT_METADATA_TABLES),))
+        present = {r[0] for r in cur.fetchall()}
+        metadata = [t for t in SNAPSHOT_METADATA_TABLES if t in present]
+        data = []
+        for table_name in metadata:
+            if table_name in SNAPSHOT_LAYOUTS:
+                cur.execute(f"SELECT partition_table_name FROM {table_name} ORDER BY partition_id;")
+                data += [r[0] for r in cur.fetchall()]
+        if ratingstablename:
+            data.append(ratingstablename)
+        if not data:
+            raise Exception("No partitions found in metadata")
+        cur.execute("""
+            SELECT relname FROM pg_class
+            WHERE relname = ANY(%s) AND (relispartition OR relkind = 'p');
+        """, (data,))
+        row = cur.fetchone()
+        if row:
+            raise ValueError(f"{row[0]} belongs to a declarative partition layout; snapshots support only plain tables.")
+
+        tables = []
+        for table_name in metadata + data:
+            cur.execute("SELECT indexdef FROM pg_indexes WHERE schemaname = 'public' AND tablename = %s;", (table_name,))
+            # Đọc kết quả trước khi _table_columns dùng lại cùng cursor
+            indexdefs = [r[0] for r in cur.fetchall()]
+            tables.append({
+                'name': table_name,
+                'file': f"{table_name}.copy",
+                'kind': 'metadata' if table_name in present else 'data',
+                'columns': _table_columns(cur, table_name),
+                # Chỉ index của bảng dữ liệu; khóa của bảng metadata do hàm create_*_metadata_table tạo lại
+                'indexes': [] if table_name in present else indexdefs,
+            })
+        cur.execute("SELECT relname, pg_relation_size(oid) FROM pg_class WHERE relname = ANY(%s);",
+                    ([t['name'] for t in tables],))
+        sizes = dict(cur.fetchall())
+        cur.execute("SHOW server_version;")
+        server_version = cur.fetchone()[0]
+        span.mark('catalog')
+
+        os.makedirs(path, exist_ok=True)
+        groups = _balanced_groups([t['name'] for t in tables], sizes, workers)
+        results = {}
+        # Kết nối điều phối giữ transaction mở để snapshot còn hiệu lực tới khi các worker xong
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            for result in pool.map(lambda group: _snapshot_worker(con, snapshot_id, path, group), groups):
+                results.update(result)
+        con.commit()
+        span.mark('copy')
+
+        for table in tables:
+            table['rows'], table['bytes'] = results[table['name']]
+        manifest = {
+            'format': 'pgcopy-binary',
+            'version': 1,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'server_version': server_version,
+            'tables': tables,
+        }
+        tmp = os.path.join(path, f"{SNAPSHOT_MANIFEST}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, os.path.join(path, SNAPSHOT_MANIFEST))
+        span.finish(sum(t['rows'] for t in tables))
+        return manifest
+    except Exception as e:
+        span.fail()
+        con.rollback()
+        print(f"Error in snapshot: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
+        con.close()
+
+def _restore_worker(openconnection, path, tables):
+    con = _open_worker_connection(openconnection)
+    cur = None
+    try:
+        cur = con.cursor()
+        counts = {}
+        for table in tables:
+            build_name = _build_table_name(table['name'])
+            columns = ', '.join(f"{name} {type_name}" for name, type_name in table['columns'])
+            cur.execute(f"DROP TABLE IF EXISTS {build_name};")
+            cur.execute(f"CREATE TABLE {build_name} ({columns});")
+            with open(os.path.join(path, table['file']), 'rb', buffering=COPY_CHUNK_BYTES) as f:
+                cur.copy_expert(f"COPY {build_name} FROM STDIN WITH (FORMAT binary)", f, size=COPY_CHUNK_BYTES)
+            counts[table['name']] = cur.rowcount
+            con.commit()
+        return counts
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        if cur:
+            cur.close()
+        con.close()
+
+def restore_partitions(path, openconnection, workers=4):
+    """Restore a snapshot_partitions() directory. Data tables are loaded into
+    build_<table> tables over `workers` connections, then the old tables are
+    replaced, indexes rebuilt, metadata reloaded and SERIAL sequences reset
+    in one transaction. Returns {table: rows}."""
+    span = Metrics.span('restore_partitions')
+    with open(os.path.join(path, SNAPSHOT_MANIFEST)) as f:
+        manifest = json.load(f)
+    data = [t for t in manifest['tables'] if t['kind'] == 'data']
+    metadata = [t for t in manifest['tables'] if t['kind'] == 'metadata']
+    names = {t['name'] for t in metadata}
+    cur = None
+    try:
+        # Tạo bảng metadata với đầy đủ khóa trước khi nạp
+        if 'range_metadata' in names:
+            create_range_partition_metadata_table(openconnection)
+        if names & {'roundrobin_metadata', 'rr_index_tracker'}:
+            create_roundrobin_partition_metadata_table(openconnection)
+        if names & {'hash_metadata', 'hash_ring'}:
+            create_hash_partition_metadata_table(openconnection)
+
+        sizes = {t['name']: t['bytes'] for t in data}
+        groups = _balanced_groups([t['name'] for t in data], sizes, workers)
+        by_name = {t['name']: t for t in data}
+        counts = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(groups))) as pool:
+                for result in pool.map(lambda group: _restore_worker(openconnection, path, [by_name[n] for n in group]),
+                                       groups):
+                    counts.update(result)
+        except Exception:
+            _drop_build_tables(openconnection, list(by_name))
+            raise
+        span.mark('copy')
+
+        cur = openconnection.cursor(cursor_factory=span.cursor_factory)
+        if 'partition_stats' in names:
+            _create_partition_stats_table(cur)
+        # Bỏ các partition hiện có mà snapshot không còn chứa
+        for table_name in names & set(SNAPSHOT_LAYOUTS):
+            cur.execute(f"SELECT partition_table_name FROM {table_name};")
+            for (stale,) in cur.fetchall():
+                if stale not in by_name:
+                    cur.execute(f"DROP TABLE IF EXISTS {stale} CASCADE;")
+        for table in data:
+            cur.execute(f"DROP TABLE IF EXISTS {table['name']} CASCADE;")
+            cur.execute(f"ALTER TABLE {_build_table_name(table['name'])} RENAME TO {table['name']};")
+            for indexdef in table['indexes']:
+                cur.execute(indexdef)
+        span.mark('swap')
+
+        for table in metadata:
+            columns = ', '.join(name for name, _ in table['columns'])
+            cur.execute(f"DELETE FROM {table['name']};")
+            with open(os.path.join(path, table['file']), 'rb') as f:
+                cur.copy_expert(f"COPY {table['name']} ({columns}) FROM STDIN WITH (FORMAT binary)", f)
+            counts[table['name']] = cur.rowcount
+            if table['name'] in SNAPSHOT_LAYOUTS:
+                cur.execute(f"""
+                    SELECT setval(pg_get_serial_sequence(%s, 'partition_id'),
+                                  COALESCE(MAX(partition_id), 1), MAX(partition_id) IS NOT NULL)
+                    FROM {table['name']};
+                """, (table['name'],))
+                _notify_layout_change(cur, SNAPSHOT_LAYOUTS[table['name']])
+        span.mark('metadata')
+
+        span.commit(openconnection)
+        span.finish(sum(counts.values()))
+        return counts
+    except Exception as e:
+        span.fail()
+        if openconnection:
+            openconnection.rollback()
+            _drop_build_tables(openconnection, [t['name'] for t in data])
+        print(f"Error in restore: {e}")
+        raise
+    finally:
+        if cur:
+            cur.close()
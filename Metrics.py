@@ -0,0 +1,206 @@
+#
+# In-memory timing and metrics for the partitioning Interface
+#
+# Off by default: span() returns a shared no-op object, so the hot paths
+# (rangeinsert/roundrobininsert) pay one attribute lookup and a few no-op calls.
+# Enable with Metrics.enable() or the DDS_METRICS=1 environment variable.
+#
+import json
+import os
+import threading
+import time
+import psycopg2.extensions
+
+# Biên trên (giây) của các bucket histogram, theo kiểu Prometheus
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+METRIC_PREFIX = 'dds'
+
+_enabled = os.environ.get('DDS_METRICS', '') not in ('', '0')
+_lock = threading.Lock()
+# (operation, phase) -> _Histogram
+_histograms = {}
+# operation -> {'calls', 'errors', 'rows', 'roundtrips'}
+_counters = {}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def enabled():
+    return _enabled
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+class _Histogram:
+    __slots__ = ('counts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+
+class _CountingCursor(psycopg2.extensions.cursor):
+    """Cursor đếm số lượt gửi lệnh tới server (mỗi execute/copy là một round-trip)."""
+    span = None
+
+    def execute(self, query, vars=None):
+        self.span.roundtrips += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        self.span.roundtrips += len(vars_list)
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        self.span.roundtrips += 1
+        return super().copy_expert(sql, file, size)
+
+
+class _Span:
+    """Timing of one call: mark() closes the current phase, finish() records the total."""
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.rows = 0
+        self.roundtrips = 0
+        self.phases = []
+        self.start = self.last = time.perf_counter()
+        # Lớp cursor riêng cho span này, truyền vào connection.cursor(cursor_factory=...)
+        self.cursor_factory = type('CountingCursor', (_CountingCursor,), {'span': self})
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def commit(self, connection):
+        # COMMIT cũng là một round-trip nhưng không đi qua cursor của span
+        self.roundtrips += 1
+        connection.commit()
+
+    def finish(self, rows=None):
+        self._record(rows, error=False)
+
+    def fail(self):
+        self._record(None, error=True)
+
+    def _record(self, rows, error):
+        total = time.perf_counter() - self.start
+        if rows is not None:
+            self.rows = rows
+        with _lock:
+            counters = _counters.setdefault(self.operation, {'calls': 0, 'errors': 0, 'rows': 0, 'roundtrips': 0})
+            counters['calls'] += 1
+            counters['roundtrips'] += self.roundtrips
+            if error:
+                counters['errors'] += 1
+                return
+            counters['rows'] += self.rows
+            for phase, seconds in self.phases:
+                _histograms.setdefault((self.operation, phase), _Histogram()).observe(seconds)
+            _histograms.setdefault((self.operation, 'total'), _Histogram()).observe(total)
+
+
+class _NoopSpan:
+    __slots__ = ()
+    cursor_factory = None
+    rows = 0
+    roundtrips = 0
+
+    def mark(self, phase):
+        pass
+
+    def commit(self, connection):
+        connection.commit()
+
+    def finish(self, rows=None):
+        pass
+
+    def fail(self):
+        pass
+
+_NOOP = _NoopSpan()
+
+
+def span(operation):
+    return _Span(operation) if _enabled else _NOOP
+
+
+def snapshot():
+    """Return every histogram and counter as a JSON-serialisable dict."""
+    with _lock:
+        operations = {}
+        for operation, counters in _counters.items():
+            operations[operation] = dict(counters, phases={})
+        for (operation, phase), h in _histograms.items():
+            entry = operations.setdefault(operation, {'calls': 0, 'errors': 0, 'rows': 0, 'roundtrips': 0, 'phases': {}})
+            entry['phases'][phase] = {
+                'count': h.count,
+                'sum': h.sum,
+                'min': h.min,
+                'max': h.max,
+                'mean': h.sum / h.count if h.count else 0.0,
+                'buckets': {str(le): c for le, c in zip(BUCKETS + ('+Inf',), h.counts)},
+            }
+        return {'buckets': list(BUCKETS), 'operations': operations}
+
+
+def _write_atomic(path, text):
+    # Ghi ra file tạm rồi đổi tên để bộ thu thập không đọc phải file đang ghi dở
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def export_json(path=None):
+    text = json.dumps(snapshot(), indent=2)
+    if path:
+        _write_atomic(path, text)
+    return text
+
+def export_prometheus(path=None):
+    """Render the metrics in the Prometheus text exposition format (textfile collector)."""
+    data = snapshot()['operations']
+    seconds = f"{METRIC_PREFIX}_operation_seconds"
+    lines = [f"# HELP {seconds} Duration of each operation phase.", f"# TYPE {seconds} histogram"]
+    for operation, entry in sorted(data.items()):
+        for phase, h in sorted(entry['phases'].items()):
+            labels = f'operation="{operation}",phase="{phase}"'
+            cumulative = 0
+            for le, c in h['buckets'].items():
+                cumulative += c
+                lines.append(f'{seconds}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{seconds}_sum{{{labels}}} {h['sum']}")
+            lines.append(f"{seconds}_count{{{labels}}} {h['count']}")
+    for counter in ('calls', 'errors', 'rows', 'roundtrips'):
+        name = f"{METRIC_PREFIX}_operation_{counter}_total"
+        lines.append(f"# TYPE {name} counter")
+        for operation, entry in sorted(data.items()):
+            lines.append(f'{name}{{operation="{operation}"}} {entry[counter]}')
+    text = "\n".join(lines) + "\n"
+    if path:
+        _write_atomic(path, text)
+    return text
@@ -65,18 +65,15 @@ def getCountrangepartition(ratingstablename, numberofpartitions, openconnection)
     :return:
     """
     cur = openconnection.cursor()
-    countList = []
     interval = 5.0 / numberofpartitions
-    cur.execute("select count(*) from {0} where rating >= {1} and rating <= {2}".format(ratingstablename,0, interval))
-    countList.append(int(cur.fetchone()[0]))
-
+    # One scan of the ratings table: one FILTERed count per partition
+    filters = ["count(*) filter (where rating >= {0} and rating <= {1})".format(0, interval)]
     lowerbound = interval
     for i in range(1, numberofpartitions):
-        cur.execute("select count(*) from {0} where rating > {1} and rating <= {2}".format(ratingstablename,
-                                                                                          lowerbound,
-                                                                                          lowerbound + interval))
+        filters.append("count(*) filter (where rating > {0} and rating <= {1})".format(lowerbound, lowerbound + interval))
         lowerbound += interval
-        countList.append(int(cur.fetchone()[0]))
+    cur.execute("select {0} from {1}".format(', '.join(filters), ratingstablename))
+    countList = [int(count) for count in cur.fetchone()]
 
     cur.close()
     return countList
@@ -91,12 +88,12 @@ def getCountroundrobinpartition(ratingstablename, numberofpartitions, openconnec
     :return:
     '''
     cur = openconnection.cursor()
-    countList = []
-    for i in range(0, numberofpartitions):
-        cur.execute(
-            "select count(*) from (select *, row_number() over () from {0}) as temp where (row_number-1)%{1}= {2}".format(
-                ratingstablename, numberofpartitions, i))
-        countList.append(int(cur.fetchone()[0]))
+    # One scan of the ratings table grouped by partition index
+    cur.execute(
+        "select (row_number-1)%{1}, count(*) from (select row_number() over () from {0}) as temp group by 1".format(
+            ratingstablename, numberofpartitions))
+    found = dict(cur.fetchall())
+    countList = [int(found.get(i, 0)) for i in range(0, numberofpartitions)]
 
     cur.close()
     return countList
@@ -123,7 +120,42 @@ def totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartin
     return count
 
 
-def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+def partitionrowcounts(cur, n, partitiontableprefix, partitionstartindex):
+    selects = []
+    for i in range(partitionstartindex, n + partitionstartindex):
+        selects.append('SELECT {2}, COUNT(*) FROM {0}{1}'.format(partitiontableprefix, i, i - partitionstartindex))
+    cur.execute(' UNION ALL '.join(selects))
+    found = dict(cur.fetchall())
+    return [int(found[i]) for i in range(0, n)]
+
+
+def rowsfingerprint(cur, selectquery):
+    """
+    Order-independent fingerprint of a multiset of rows: row count plus two sums of 64-bit row hashes
+    :return: (count, sum of hashes with seed 0, sum of hashes with seed 1)
+    """
+    row = "concat_ws(',', {0}, {1}, {2})".format(USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME)
+    cur.execute('SELECT COUNT(*), COALESCE(SUM(hashtextextended({0}, 0)::numeric), 0), '
+                'COALESCE(SUM(hashtextextended({0}, 1)::numeric), 0) FROM ({1}) AS T'.format(row, selectquery))
+    return tuple(cur.fetchone())
+
+
+def testpartitionfingerprint(cur, ratingstablename, n, partitiontableprefix, partitionstartindex):
+    # The partitions, taken together, must hold exactly the rows of the ratings table: no row lost, none duplicated
+    selects = []
+    for i in range(partitionstartindex, n + partitionstartindex):
+        selects.append('SELECT {2}, {3}, {4} FROM {0}{1}'.format(partitiontableprefix, i, USER_ID_COLNAME,
+                                                                 MOVIE_ID_COLNAME, RATING_COLNAME))
+    expected = rowsfingerprint(cur, 'SELECT {1}, {2}, {3} FROM {0}'.format(ratingstablename, USER_ID_COLNAME,
+                                                                          MOVIE_ID_COLNAME, RATING_COLNAME))
+    found = rowsfingerprint(cur, ' UNION ALL '.join(selects))
+    if found != expected: raise Exception(
+        "Disjointness property of Partitioning failed. Rows in {0} partitions do not match the rows of {1} "
+        "(fingerprint {2} != {3})".format(partitiontableprefix, ratingstablename, found, expected))
+
+
+def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE,
+                                  ratingstablename=None):
     with openconnection.cursor() as cur:
         if not isinstance(n, int) or n < 0:
             # Test 1: Check the number of tables created, if 'n' is invalid
@@ -132,24 +164,28 @@ def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix,
             # Test 2: Check the number of tables created, if all args are correct
             checkpartitioncount(cur, n, rangepartitiontableprefix)
 
-            # Test 3: Test Completeness by SQL UNION ALL Magic
+            # The UNION ALL count is computed once and reused by Tests 3-5
             count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
+
+            # Test 3: Test Completeness by SQL UNION ALL Magic
             if count < ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Completeness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
 
             # Test 4: Test Disjointness by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
             if count > ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Dijointness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
 
             # Test 5: Test Reconstruction by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
             if count != ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Rescontruction property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
 
+            # Test 6 (optional): Test Disjointness row by row with hash fingerprints
+            if ratingstablename:
+                testpartitionfingerprint(cur, ratingstablename, n, rangepartitiontableprefix, partitionstartindex)
+
 
 def testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
     with openconnection.cursor() as cur:
@@ -166,9 +202,9 @@ def testrangerobininsert(expectedtablename, itemid, openconnection, rating, user
 def testEachRangePartition(ratingstablename, n, openconnection, rangepartitiontableprefix):
     countList = getCountrangepartition(ratingstablename, n, openconnection)
     cur = openconnection.cursor()
+    counts = partitionrowcounts(cur, n, rangepartitiontableprefix, 0)
     for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(rangepartitiontableprefix, i))
-        count = int(cur.fetchone()[0])
+        count = counts[i]
         if count != countList[i]:
             raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
                 rangepartitiontableprefix, i, count, countList[i]
@@ -177,9 +213,9 @@ def testEachRangePartition(ratingstablename, n, openconnection, rangepartitionta
 def testEachRoundrobinPartition(ratingstablename, n, openconnection, roundrobinpartitiontableprefix):
     countList = getCountroundrobinpartition(ratingstablename, n, openconnection)
     cur = openconnection.cursor()
+    counts = partitionrowcounts(cur, n, roundrobinpartitiontableprefix, 0)
     for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(roundrobinpartitiontableprefix, i))
-        count = cur.fetchone()[0]
+        count = counts[i]
         if count != countList[i]:
             raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
                 roundrobinpartitiontableprefix, i, count, countList[i]
@@ -211,19 +247,22 @@ def testloadratings(MyAssignment, ratingstablename, filepath, openconnection, ro
     return [True, None]
 
 
-def testrangepartition(MyAssignment, ratingstablename, n, openconnection, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+def testrangepartition(MyAssignment, ratingstablename, n, openconnection, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE,
+                       fingerprint=False):
     """
     Tests the range partition function for Completness, Disjointness and Reconstruction
     :param ratingstablename: Argument for function to be tested
     :param n: Argument for function to be tested
     :param openconnection: Argument for function to be tested
     :param partitionstartindex: Indicates how the table names are indexed. Do they start as rangepart1, 2 ... or rangepart0, 1, 2...
+    :param fingerprint: Also compare row hash fingerprints of the partitions against the ratings table
     :return:Raises exception if any test fails
     """
 
     try:
         MyAssignment.rangepartition(ratingstablename, n, openconnection)
-        testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
+        testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE,
+                                      ratingstablename if fingerprint else None)
         testEachRangePartition(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX)
         return [True, None]
     except Exception as e:
@@ -232,18 +271,20 @@ def testrangepartition(MyAssignment, ratingstablename, n, openconnection, partit
 
 
 def testroundrobinpartition(MyAssignment, ratingstablename, numberofpartitions, openconnection,
-                            partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+                            partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE, fingerprint=False):
     """
     Tests the round robin partitioning for Completness, Disjointness and Reconstruction
     :param ratingstablename: Argument for function to be tested
     :param numberofpartitions: Argument for function to be tested
     :param openconnection: Argument for function to be tested
     :param robinpartitiontableprefix: This function assumes that you tables are named in an order. Eg: robinpart1, robinpart2...
+    :param fingerprint: Also compare row hash fingerprints of the partitions against the ratings table
     :return:Raises exception if any test fails
     """
     try:
         MyAssignment.roundrobinpartition(ratingstablename, numberofpartitions, openconnection)
-        testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
+        testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE,
+                                      ratingstablename if fingerprint else None)
         testEachRoundrobinPartition(ratingstablename, numberofpartitions, openconnection, RROBIN_TABLE_PREFIX)
     except Exception as e:
         traceback.print_exc()
@@ -295,4 +336,42 @@ def testrangeinsert(MyAssignment, ratingstablename, userid, itemid, rating, open
     except Exception as e:
         traceback.print_exc()
         return [False, e]
-    return [True, None]
\ No newline at end of file
+    return [True, None]
+
+def partitionindexes(cur, prefix):
+    cur.execute(
+        "SELECT tablename, indexname, indexdef FROM pg_indexes WHERE schemaname = 'public' AND tablename LIKE '{0}%' "
+        "ORDER BY 1, 2".format(prefix))
+    return cur.fetchall()
+
+
+def testsnapshotrestore(MyAssignment, path, n, openconnection, partitiontableprefix, partitionstartindex):
+    """
+    Tests snapshot_partitions/restore_partitions by a round trip: row counts and index definitions of the partitions
+    must be the same after the restore as before the snapshot
+    :param path: Directory the snapshot is written to
+    :param n: Number of partitions with the given prefix
+    :param openconnection: Argument for function to be tested
+    :param partitiontableprefix: Prefix of the partition tables to compare, eg. range_part
+    :param partitionstartindex: Indicates how the table names are indexed
+    :return:Raises exception if any test fails
+    """
+    try:
+        with openconnection.cursor() as cur:
+            counts = partitionrowcounts(cur, n, partitiontableprefix, partitionstartindex)
+            indexes = partitionindexes(cur, partitiontableprefix)
+        openconnection.commit()
+        MyAssignment.snapshot_partitions(path, openconnection)
+        MyAssignment.restore_partitions(path, openconnection)
+        with openconnection.cursor() as cur:
+            found = partitionrowcounts(cur, n, partitiontableprefix, partitionstartindex)
+            if found != counts:
+                raise Exception('Restore changed the partition row counts: {0} before, {1} after'.format(counts, found))
+            foundindexes = partitionindexes(cur, partitiontableprefix)
+            if foundindexes != indexes:
+                raise Exception('Restore changed the partition indexes: {0} before, {1} after'.format(indexes,
+                                                                                                    foundindexes))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]